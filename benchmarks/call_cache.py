@@ -0,0 +1,34 @@
+""" Microbenchmark for :meth:`chdkptp.lua.LuaContext.call`.
+
+Runs against a stub `con` object, so no camera needs to be attached.
+"""
+import timeit
+
+from chdkptp.lua import LuaContext
+
+
+class StubLuaContext(LuaContext):
+    def _setup_runtime(self):
+        self._rt.execute("""
+            con = {}
+            function con:is_connected()
+                return true
+            end
+            function con:write_msg(msg, script_id)
+                return true
+            end
+        """)
+
+
+def run(number=20000):
+    for cache_size in (0, 128):
+        ctx = StubLuaContext(call_cache_size=cache_size)
+        timer = timeit.Timer(lambda: (ctx.call("con:is_connected"),
+                                      ctx.call("con:write_msg", "ping", 1)))
+        best = min(timer.repeat(repeat=3, number=number))
+        print "call_cache_size={0:<4} {1:8.2f} us/call  {2}".format(
+            cache_size, best / (2 * number) * 1e6, ctx.call_cache_info())
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,43 @@
+""" Benchmark for parallel encoding of live view frames.
+
+Uses synthetic frames, so no camera needs to be attached.
+"""
+import itertools
+import time
+
+import numpy
+
+from chdkptp.liveview import Frame, FrameEncoder, get_converter
+
+
+def synthetic_frames(num, width=720, height=240):
+    rand = numpy.random.RandomState(0)
+    pixels = [rand.randint(0, 256, size=(height, width, 3))
+                  .astype(numpy.uint8).tobytes() for _ in xrange(4)]
+    return [Frame(width, height, data)
+            for data in itertools.islice(itertools.cycle(pixels), num)]
+
+
+def run(num_frames=400, format='jpg'):
+    frames = synthetic_frames(num_frames)
+    convert = get_converter(format, scaled=False)
+    start = time.time()
+    for frame in frames:
+        convert(frame)
+    print "{0:<20} {1:8.1f} frames/s".format(
+        "inline", num_frames / (time.time() - start))
+    for processes in (False, True):
+        for workers in (2, 4):
+            encoder = FrameEncoder(format, scaled=False, workers=workers,
+                                   processes=processes)
+            start = time.time()
+            for _ in encoder.encode(frames):
+                pass
+            print "{0:<20} {1:8.1f} frames/s".format(
+                "{0} {1}".format(workers,
+                                 "processes" if processes else "threads"),
+                num_frames / (time.time() - start))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,34 @@
+""" Benchmark for the time it takes to import the package and to run the
+    exposure conversions.
+"""
+import subprocess
+import sys
+import time
+import timeit
+
+
+def time_import(module, repeat=5):
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'import ' + module])
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def run():
+    baseline = time_import('sys')
+    for module in ('chdkptp', 'chdkptp.util'):
+        print "import {0:<16} {1:8.1f} ms".format(
+            module, (time_import(module) - baseline) * 1e3)
+    timer = timeit.Timer("iso_to_sv96(200); shutter_to_tv96(1/60.);"
+                         "aperture_to_av96(5.6)",
+                         "from chdkptp.util import (iso_to_sv96, "
+                         "shutter_to_tv96, aperture_to_av96)")
+    number = 100000
+    print "exposure conversions   {0:8.2f} us".format(
+        min(timer.repeat(3, number)) / (3 * number) * 1e6)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,4 +1,10 @@
-from chdkptp.device import ChdkDevice, list_devices, DeviceInfo
+from chdkptp.device import (ChdkDevice, list_devices, clear_device_cache,
+                            mode_switch_stats, DeviceInfo)
+from chdkptp.group import DeviceGroup
+from chdkptp.liveview import Frame
+from chdkptp.pool import DevicePool
 
 __version__ = "0.1.3"
-__all__ = ['ChdkDevice', 'list_devices', 'DeviceInfo']
+__all__ = ['ChdkDevice', 'list_devices', 'clear_device_cache',
+           'mode_switch_stats', 'DeviceInfo', 'DeviceGroup', 'DevicePool',
+           'Frame']
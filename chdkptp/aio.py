@@ -0,0 +1,148 @@
+""" asyncio front-end for :class:`chdkptp.ChdkDevice`.
+
+Like the rest of the package, this requires Python 2, so the event loop is
+provided by `trollius`, the Python 2 backport of :mod:`asyncio`. Coroutines
+use `yield From(...)` instead of `await`.
+"""
+from chdkptp.group import DeviceWorker
+from chdkptp.liveview import FrameFetcher, get_converter
+
+try:
+    import trollius as asyncio
+except ImportError:
+    asyncio = None
+
+
+class AsyncChdkDevice(object):
+    """ Wrapper around a :class:`chdkptp.ChdkDevice` whose methods return
+        awaitable futures instead of blocking.
+
+    All calls into the device's Lua runtime are run one after the other in a
+    dedicated thread, so the event loop is never blocked and concurrent
+    calls cannot interfere with each other.
+    """
+    def __init__(self, device, loop=None):
+        """ Create a new wrapper.
+
+        :param device:  Device to wrap
+        :type device:   :class:`chdkptp.ChdkDevice`
+        :param loop:    Event loop to use, defaults to the current one
+        """
+        if asyncio is None:
+            raise RuntimeError("To use the asyncio front-end, please install "
+                               "the `trollius` package.")
+        self.device = device
+        self._loop = loop or asyncio.get_event_loop()
+        self._worker = DeviceWorker(device)
+
+    def run(self, func, *args, **kwargs):
+        """ Call a function with the device as its first argument in the
+            device's thread.
+
+        :param func:    Function to call
+        :type func:     callable
+        :rtype:         :class:`asyncio.Future`
+        """
+        future = asyncio.Future(loop=self._loop)
+        job = self._worker.submit(func, self.device, *args, **kwargs)
+        job.add_done_callback(
+            lambda job: self._loop.call_soon_threadsafe(
+                _transfer_result, job, future))
+        return future
+
+    def shoot(self, **kwargs):
+        """ See :meth:`chdkptp.ChdkDevice.shoot`. """
+        return self.run(lambda dev: dev.shoot(**kwargs))
+
+    def lua_execute(self, lua_code, **kwargs):
+        """ See :meth:`chdkptp.ChdkDevice.lua_execute`. """
+        return self.run(lambda dev: dev.lua_execute(lua_code, **kwargs))
+
+    def download_file(self, remote_path, local_path=None, **kwargs):
+        """ See :meth:`chdkptp.ChdkDevice.download_file`. """
+        return self.run(lambda dev: dev.download_file(remote_path, local_path,
+                                                      **kwargs))
+
+    def list_files(self, remote_path='A/DCIM', detailed=False, **kwargs):
+        """ See :meth:`chdkptp.ChdkDevice.list_files`. """
+        return self.run(lambda dev: dev.list_files(remote_path, detailed,
+                                                   **kwargs))
+
+    def send_message(self, message, script_id=None):
+        """ See :meth:`chdkptp.ChdkDevice.send_message`. """
+        return self.run(lambda dev: dev.send_message(message, script_id))
+
+    def messages(self, poll_interval=0.05):
+        """ Asynchronous iterator over the messages from the device.
+
+        The iterator never ends, it polls the device for new messages every
+        `poll_interval` seconds while the message buffer is empty.
+
+        :param poll_interval:   Time in seconds between polls
+        :type poll_interval:    float
+        """
+        def read_message(dev):
+            return next(dev.get_messages(), None)
+        return _AsyncPollingIterator(self, read_message, poll_interval)
+
+    def frames(self, format='ppm', scaled=None):
+        """ Asynchronous iterator over the frames from the device's viewport,
+            see :meth:`chdkptp.ChdkDevice.get_frames`.
+        """
+        if scaled is None:
+            scaled = format in ('ppm', None)
+        convert = get_converter(format, scaled=scaled)
+        fetchers = []
+
+        def fetch_frame(dev):
+            # The fetcher has to be compiled in the device's thread as well
+            if not fetchers:
+                fetchers.append(FrameFetcher(dev._lua, scaled=scaled))
+            return convert(fetchers[0]())
+        return _AsyncPollingIterator(self, fetch_frame)
+
+    def close(self):
+        """ Stop the device's thread after all pending calls are done. """
+        self._worker.stop(wait=False)
+
+
+class _AsyncPollingIterator(object):
+    """ Iterator whose `next` method returns a future, the future's result
+        is obtained by calling a function in the device's thread until it
+        returns something other than `None`.
+    """
+    def __init__(self, async_device, func, poll_interval=0):
+        self._device = async_device
+        self._func = func
+        self._poll_interval = poll_interval
+
+    def next(self):
+        """ Get a future for the next item, use with
+            `item = yield From(iterator.next())`.
+        """
+        loop = self._device._loop
+        future = asyncio.Future(loop=loop)
+
+        def attempt():
+            self._device.run(self._func).add_done_callback(check)
+
+        def check(result):
+            if future.cancelled():
+                return
+            if result.exception() is not None:
+                future.set_exception(result.exception())
+            elif result.result() is None:
+                loop.call_later(self._poll_interval, attempt)
+            else:
+                future.set_result(result.result())
+        attempt()
+        return future
+
+
+def _transfer_result(job, future):
+    if future.cancelled():
+        return
+    if job.exc_info is not None:
+        future.set_exception(job.exc_info[1])
+    else:
+        future.set_result(job.value)
@@ -1,11 +1,31 @@
+import io
 import os
 import re
-import StringIO
+import shutil
+import sys
 import tempfile
-from collections import namedtuple
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
 from numbers import Number
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+from chdkptp.liveview import (FrameEncoder, FrameFetcher, FramePrefetcher,
+                              get_converter)
 from chdkptp.lua import LuaContext, global_lua, parse_table
+from chdkptp.script import PreparedScript
+from chdkptp.serialize import serialize, unserialize
+from chdkptp.session import ShootingSession
+from chdkptp.sync import sync
+from chdkptp.transfer import (RemoteFile, batch_download, batch_upload,
+                              iter_download)
+import chdkptp.raw as raw
 import chdkptp.util as util
 
 from lupa import LuaError
@@ -20,55 +40,295 @@ DISTANCE_FACTORS = {
     'in': 25.4
 }
 
+DOWNLOAD_CHUNK_SIZE = 64*1024
+DEVICE_CACHE_TTL = 300
+MESSAGE_BATCH_SIZE = 32
+MODE_SWITCH_TIMEOUT = 3000
+LIST_BATCH_SIZE = 64
+
 Message = namedtuple("Message", ('type', 'script_id', 'value'))
+ShotResult = namedtuple("ShotResult", ('index', 'data', 'wait_time',
+                                       'transfer_time'))
 DeviceInfo = namedtuple("DeviceInfo", ('model_name', 'bus_num', 'device_num',
                                        'vendor_id', 'product_id',
                                        'serial_num', 'chdk_api'))
+ModeSwitchStats = namedtuple("ModeSwitchStats", ('switches', 'total_time',
+                                                 'mean_time', 'min_time',
+                                                 'max_time'))
+
+# Walks a directory tree on the device and sends the files as messages of
+# the form {directory, name1, size1, mtime1, name2, ...}
+_WALK_SCRIPT = """
+local pending = {root}
+local count = 0
+local function send(batch)
+    if not write_usb_msg(batch, 10000) then
+        error('timed out sending directory listing')
+    end
+end
+while #pending > 0 do
+    local dir = table.remove(pending)
+    local names, err = os.listdir(dir)
+    if not names then
+        error(err)
+    end
+    local batch = {dir}
+    for i, name in ipairs(names) do
+        local st = os.stat(dir .. '/' .. name)
+        if st and st.is_dir then
+            table.insert(pending, dir .. '/' .. name)
+        elseif st and (not pattern or string.find(string.lower(name), pattern))
+               and (not newer_than or st.mtime > newer_than) then
+            batch[#batch+1] = name
+            batch[#batch+1] = st.size
+            batch[#batch+1] = st.mtime
+            count = count + 1
+            if #batch > batch_size*3 then
+                send(batch)
+                batch = {dir}
+            end
+        end
+    end
+    if #batch > 1 then
+        send(batch)
+    end
+end
+return count
+"""
+
+# Device information by bus and device number, with the time it was read
+_device_cache = {}
+_device_cache_lock = threading.Lock()
 
+# Mode switch latencies by model name, as [switches, total, min, max]
+_mode_switch_times = {}
+_mode_switch_lock = threading.Lock()
 
-def list_devices():
+
+def list_devices(refresh=False, ttl=DEVICE_CACHE_TTL):
     """ Lists all recognized PTP devices on the USB bus.
 
-    :return:  All connected PTP devices
-    :rtype:   List of `DeviceInfo` named tuples
+    Reading the model name, serial number and API version of a device
+    requires connecting to it, so the results are cached by bus and device
+    number and only new devices are connected to on subsequent calls.
+
+    :param refresh:     Ignore cached information and connect to all
+                        devices again
+    :type refresh:      bool
+    :param ttl:         Maximum age of cached information in seconds
+    :type ttl:          int/float
+    :return:            All connected PTP devices
+    :rtype:             List of `DeviceInfo` named tuples
     """
-    devices = global_lua.execute("""
+    now = time.time()
+    usb_devices = [dict(desc) for desc in global_lua.execute("""
         local info = {}
-        local devs = chdk.list_usb_devices()
-        for i, desc in ipairs(devs) do
-            local lcon = chdku.connection(desc)
-            lcon:connect()
+        for i, desc in ipairs(chdk.list_usb_devices()) do
             table.insert(info, {
-                model_name = lcon.ptpdev.model,
-                bus_num = lcon.condev.bus,
-                device_num = lcon.condev.dev,
-                vendor_id = lcon.condev.vendor_id,
-                product_id = lcon.condev.product_id,
-                serial_num = lcon.ptpdev.serial_number,
-                chdk_api = lcon.apiver,
+                bus = desc.bus,
+                dev = desc.dev,
+                vendor_id = desc.vendor_id,
+                product_id = desc.product_id,
             })
-            lcon:disconnect()
         end
-        return info;
-        """)
-    infos = []
-    for dev_info in devices.values():
-        dev_info = dict(dev_info)
-        dev_info['chdk_api'] = (dev_info['chdk_api'].MAJOR,
-                                dev_info['chdk_api'].MINOR)
-        infos.append(DeviceInfo(**dev_info))
-    return infos
+        return info
+        """).values()]
+    with _device_cache_lock:
+        if refresh:
+            _device_cache.clear()
+        stale = [desc for desc in usb_devices
+                 if _get_cached_info(desc, now, ttl) is None]
+        if stale:
+            for dev_info in global_lua.eval("""
+                function(descs)
+                    local info = {}
+                    for i, desc in ipairs(descs) do
+                        local lcon = chdku.connection(desc)
+                        lcon:connect()
+                        table.insert(info, {
+                            model_name = lcon.ptpdev.model,
+                            bus_num = lcon.condev.bus,
+                            device_num = lcon.condev.dev,
+                            vendor_id = lcon.condev.vendor_id,
+                            product_id = lcon.condev.product_id,
+                            serial_num = lcon.ptpdev.serial_number,
+                            chdk_api = lcon.apiver,
+                        })
+                        lcon:disconnect()
+                    end
+                    return info
+                end
+                """)(global_lua.table(*(global_lua.table(**desc)
+                                        for desc in stale))).values():
+                dev_info = dict(dev_info)
+                dev_info['chdk_api'] = (dev_info['chdk_api'].MAJOR,
+                                        dev_info['chdk_api'].MINOR)
+                info = DeviceInfo(**dev_info)
+                _device_cache[(info.bus_num, info.device_num)] = (info, now)
+        # Forget about devices that were unplugged
+        present = set((desc['bus'], desc['dev']) for desc in usb_devices)
+        for key in list(_device_cache):
+            if key not in present:
+                del _device_cache[key]
+        return [_device_cache[(desc['bus'], desc['dev'])][0]
+                for desc in usb_devices
+                if (desc['bus'], desc['dev']) in _device_cache]
+
+
+def _get_cached_info(desc, now, ttl):
+    info, timestamp = _device_cache.get((desc['bus'], desc['dev']),
+                                        (None, None))
+    if info is None or now - timestamp > ttl:
+        return None
+    # Device numbers can be re-used by a different device
+    if (info.vendor_id, info.product_id) != (desc['vendor_id'],
+                                             desc['product_id']):
+        return None
+    return info
+
+
+def clear_device_cache():
+    """ Discard all cached device information, see :func:`list_devices`. """
+    with _device_cache_lock:
+        _device_cache.clear()
+
+
+def _record_mode_switch(model_name, duration):
+    with _mode_switch_lock:
+        times = _mode_switch_times.get(model_name)
+        if times is None:
+            _mode_switch_times[model_name] = [1, duration, duration, duration]
+            return
+        times[0] += 1
+        times[1] += duration
+        times[2] = min(times[2], duration)
+        times[3] = max(times[3], duration)
+
+
+def mode_switch_stats(model_name=None):
+    """ Latencies of all mode switches done with
+        :meth:`ChdkDevice.switch_mode`, in seconds, per camera model.
+
+    The latency is measured on the device, from requesting the switch until
+    the device reports the new mode.
+
+    :param model_name:  Only return statistics for this model
+    :type model_name:   str
+    :returns:           Statistics by model name, or the statistics for
+                        `model_name` (`None` if no switches were recorded)
+    :rtype:             dict of :class:`ModeSwitchStats`
+                        or :class:`ModeSwitchStats`
+    """
+    with _mode_switch_lock:
+        stats = dict(
+            (model, ModeSwitchStats(count, total, total/count, min_, max_))
+            for model, (count, total, min_, max_)
+            in _mode_switch_times.iteritems())
+    if model_name is not None:
+        return stats.get(model_name)
+    return stats
+
+
+@contextmanager
+def _chunk_writer(output):
+    """ Provide a function that writes chunks of data at their offsets to
+        a local path, a file object or a callable.
+
+    Offsets are relative to the position of a file object when the writer
+    is created. Chunks that arrive in order are written sequentially, so
+    unseekable file objects like pipes and sockets can be used as long as
+    no chunk arrives out of order.
+    """
+    if callable(output):
+        yield output
+        return
+    if isinstance(output, basestring):
+        fp = open(output, 'wb')
+    else:
+        fp = output
+    try:
+        start = fp.tell()
+    except (IOError, OSError, AttributeError):
+        # Not seekable
+        start = None
+    next_offset = [0]
+
+    def write(data, offset):
+        if offset != next_offset[0]:
+            if start is None:
+                raise IOError("Cannot write chunk at offset {0} to an "
+                              "unseekable output, expected offset {1}"
+                              .format(offset, next_offset[0]))
+            fp.seek(start + offset)
+        fp.write(data)
+        next_offset[0] = offset + len(data)
+    try:
+        yield write
+    finally:
+        if fp is not output:
+            fp.close()
+
+
+def _copy_chunks(fd, write, offset=0, length=None,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """ Read all data from a file descriptor and pass the chunks in the
+        range given by `offset` and `length` to `write`.
+    """
+    pos = 0
+    end = None if length is None else offset + length
+    while True:
+        data = os.read(fd, chunk_size)
+        if not data:
+            break
+        start, stop = pos, pos + len(data)
+        pos = stop
+        if stop <= offset or (end is not None and start >= end):
+            continue
+        data = data[max(offset - start, 0):
+                    len(data) if end is None else end - start]
+        write(data, max(start - offset, 0))
+
+
+def _ensure_return(lua_code):
+    if "return" in lua_code:
+        return lua_code
+    if ";" not in lua_code[:-1] and "\n" not in lua_code:
+        return "return " + lua_code
+    raise ValueError(
+        "`do_return` was specified, but no return statement was"
+        " specified in the supplied `lua_code`. Please change your"
+        " script so that it returns the value you want.")
+
+
+class _DetachedLua(object):
+    """ Stands in for the Lua runtime of a device whose runtime was handed
+        on to another device.
+    """
+    def __getattr__(self, name):
+        raise RuntimeError("The device has been released, its Lua runtime "
+                           "is no longer available.")
 
 
 class ChdkDevice(object):
-    def __init__(self, device_info):
+    def __init__(self, device_info, lua=None):
         """ Create a new device instance and connect to the CHDK device.
 
         :param device_info:   Information about device to connect to
         :type device_info:    :class:`DeviceInfo`
+        :param lua:           (Optional) existing Lua context to use for the
+                              connection. Must not be shared with another
+                              device.
+        :type lua:            :class:`chdkptp.lua.LuaContext`
         """
         self.info = device_info
-        self._lua = LuaContext()
+        self._lua = lua or LuaContext()
+        self._message_reader = None
+        # Messages that were read from the device, but not yet consumed
+        self._message_buffer = deque()
+        self._executor = None
+        self._get_mode = None
+        self._switch_mode = None
+        self._serialize_libs = self._lua.table('serialize_msgs')
         self._lua.globals.devspec = self.info._asdict()
         self._lua.pexecute("""
         con = chdku.connection({bus = devspec.bus_num,
@@ -84,51 +344,132 @@ class ChdkDevice(object):
     @property
     def mode(self):
         """ The current mode of the device, one of `record` or `play`. """
-        is_record, is_video, _ = self.lua_execute('sleep(50); return get_mode()')
+        if self._get_mode is None:
+            self._get_mode = self.prepare('return get_mode()')
+        is_record, is_video, _ = self._get_mode()
         return 'record' if is_record else 'play'
 
-    def switch_mode(self, mode):
+    def switch_mode(self, mode, timeout=MODE_SWITCH_TIMEOUT):
         """ Change the mode of the device, must be one of `record` or `play`.
+
+        The current mode is checked and the switch is done in a single
+        script on the device, which returns as soon as the device reports the
+        new mode. The latency of the switch is recorded for the device's
+        model, see :func:`mode_switch_stats`.
+
+        :param mode:    Mode to switch to
+        :type mode:     str
+        :param timeout: Maximum time to wait for the switch, in milliseconds
+        :type timeout:  int
+        :returns:       Time it took the device to switch in seconds, `None`
+                        if the device already was in the requested mode
+        :rtype:         float
         """
         if mode not in ('play', 'record'):
             raise ValueError("`mode` must be one of 'play' or 'record'")
-        if self.mode == mode:
-            return
-        mode_num = int(mode == 'record')
-        status, error = self.lua_execute("""
-            sleep(50)
-            switch_mode_usb(%d)
-            local i = 0
-            while (get_mode() and 1 or 0) ~= %d and i < 300 do
-                sleep(10)
-                i = i + 1
-            end
-            if (get_mode() and 1 or 0) ~= %d then
-                return false, 'switch failed'
-            end
-            return true, ""
-            """ % (mode_num, mode_num, mode_num))
-        if not status:
-            raise RuntimeError('Could not switch mode')
+        if self._switch_mode is None:
+            self._switch_mode = self.prepare("""
+                local want = record == 1
+                if get_mode() == want then
+                    return 'unchanged', 0
+                end
+                local start = get_tick_count()
+                switch_mode_usb(record)
+                while get_mode() ~= want do
+                    if get_tick_count() - start > timeout then
+                        return 'timeout', get_tick_count() - start
+                    end
+                    sleep(10)
+                end
+                return 'switched', get_tick_count() - start
+                """, params=('record', 'timeout'))
+        status, elapsed = self._switch_mode(int(mode == 'record'), timeout)
+        if status == 'timeout':
+            raise RuntimeError('Could not switch mode, device did not switch '
+                               'within {0}ms'.format(elapsed))
+        if status == 'unchanged':
+            return None
+        duration = elapsed/1000.
+        _record_mode_switch(self.info.model_name, duration)
+        return duration
 
     def _parse_message(self, raw_msg):
         value = raw_msg.value
         if raw_msg.subtype == 'table':
-            value = parse_table(self._lua.eval(raw_msg.value))
+            value = unserialize(raw_msg.value)
         return Message(type=raw_msg.type, script_id=raw_msg.script_id,
                        value=value)
 
-    def get_messages(self):
+    def _read_messages(self, max_messages):
+        if self._message_reader is None:
+            self._message_reader = self._lua.eval("""
+                function(max_messages)
+                    local msgs = {}
+                    for i=1,max_messages do
+                        local msg = con:read_msg()
+                        if msg.type == 'none' then
+                            break
+                        end
+                        msgs[i] = msg
+                    end
+                    return msgs
+                end
+            """)
+        return [self._parse_message(raw_msg) for raw_msg in
+                self._message_reader(max_messages).values()]
+
+    def get_messages(self, batch_size=MESSAGE_BATCH_SIZE):
         """ Get all messages from device buffer
 
+        :param batch_size:  Maximum number of messages to read from the
+                            device at once
+        :type batch_size:   int
         :return:    Messages
         :rtype:     generator, yields :class:`Message`
         """
         while True:
-            raw_msg = self._con.read_msg(self._con)
-            if raw_msg.type == 'none':
-                raise StopIteration()
-            yield self._parse_message(raw_msg)
+            # Messages that are not consumed stay in the buffer for the next
+            # call, even if the generator is discarded
+            while self._message_buffer:
+                yield self._message_buffer.popleft()
+            messages = self._read_messages(batch_size)
+            self._message_buffer.extend(messages)
+            if len(messages) < batch_size:
+                while self._message_buffer:
+                    yield self._message_buffer.popleft()
+                return
+
+    def stream_messages(self, poll_interval=0.01, timeout=None,
+                        batch_size=MESSAGE_BATCH_SIZE):
+        """ Continuously get messages from the device.
+
+        In contrast to :meth:`get_messages`, this does not stop when the
+        message buffer is empty, but polls the device for new messages
+        until `timeout` seconds have passed without a new message.
+
+        :param poll_interval:   Time in seconds to wait before polling again
+                                if the buffer is empty
+        :type poll_interval:    float
+        :param timeout:         Stop when no message has been received for
+                                this number of seconds, never stop if `None`
+        :type timeout:          float
+        :param batch_size:      Maximum number of messages to read from the
+                                device at once
+        :type batch_size:       int
+        :rtype:                 generator, yields :class:`Message`
+        """
+        last_message = time.time()
+        while True:
+            messages = self._read_messages(batch_size)
+            self._message_buffer.extend(messages)
+            while self._message_buffer:
+                yield self._message_buffer.popleft()
+            if messages:
+                last_message = time.time()
+            elif timeout is not None and time.time() - last_message > timeout:
+                return
+            if len(messages) < batch_size:
+                time.sleep(poll_interval)
 
     def send_message(self, message, script_id=None):
         """ Send a message to the device
@@ -161,40 +502,124 @@ class ChdkDevice(object):
 
         :rtype:             bool/int/unicode/dict/tuple
         """
-        # TODO: This should all really work with LuaContext.call, but for some
-        # reason it fucks up the return values .-/
-        remote_libs = "{%s}" % ", ".join("'%s'" % lib for lib in remote_libs)
+        remote_libs = self._lua.table(*remote_libs)
         if not wait:
-            self._lua.pexecute("con:exec([[%s]], {libs=%s})"
-                               % (lua_code, remote_libs))
+            self._execute(lua_code, remote_libs, wait=False)
             return None
-        if do_return and "return" not in lua_code:
-            if ";" not in lua_code[:-1] and "\n" not in lua_code:
-                lua_code = "return " + lua_code
-            else:
-                raise ValueError(
-                    "`do_return` was specified, but no return statement was"
-                    " specified in the supplied `lua_code`. Please change your"
-                    " script so that it returns the value you want.")
-        # NOTE: Because of the frequency of curly braces, we prefer old-style
-        # string formatting in this case, since this saves us quite a bit of
-        # escaping
-        lua_rvals, msgs = self._lua.pexecute("""
-            local rvals = {}
-            local msgs = {}
-            con:execwait([[%s]], {rets=rvals, msgs=msgs, libs=%s})
-            return {rvals, msgs}
-            """ % (lua_code, remote_libs)).values()
+        if do_return:
+            lua_code = _ensure_return(lua_code)
+        lua_rvals = self._execute(lua_code, remote_libs)
         if not do_return:
             return None
+        return self._parse_return_values(lua_rvals)
+
+    def _execute(self, lua_code, remote_libs, wait=True):
+        """ Run code on the device, the code and library names are passed to
+            a precompiled host-side function, so they need no quoting.
+        """
+        if self._executor is None:
+            self._executor = self._lua.eval("""
+                function(code, libs, wait)
+                    return pcall(function()
+                        if not wait then
+                            con:exec(code, {libs=libs})
+                            return
+                        end
+                        local rvals = {}
+                        local msgs = {}
+                        con:execwait(code, {rets=rvals, msgs=msgs,
+                                            libs=libs})
+                        return rvals
+                    end)
+                end
+            """)
+        return self._lua._parse_rval(
+            self._executor(lua_code, remote_libs, wait))
+
+    def _parse_return_values(self, lua_rvals):
         return_values = []
         for rv in lua_rvals.values():
-            return_values.append(self._parse_message(rv).value)
+            value = rv.value
+            if rv.subtype == 'table':
+                value = unserialize(value)
+            return_values.append(value)
         if len(return_values) == 1:
             return return_values[0]
         else:
             return tuple(return_values)
 
+    def evaluate(self, *expressions):
+        """ Evaluate multiple Lua expressions on the device in a single
+            round-trip.
+
+        >>> device.evaluate('get_mode()', 'get_zoom()', 'get_tv96()')
+        [(True, False, 258), 0, 576]
+
+        :param expressions: Lua expressions to evaluate
+        :type expressions:  str/unicode
+        :return:            The value of every expression, expressions with
+                            multiple values return a tuple
+        :rtype:             list
+        """
+        if not expressions:
+            return []
+        code = "return " + ", ".join("{%s}" % expr for expr in expressions)
+        lua_rvals = self._execute(code, self._serialize_libs)
+        results = []
+        for rv in lua_rvals.values():
+            values = unserialize(rv.value)
+            if isinstance(values, dict):
+                # Table with holes due to nil values
+                values = tuple(values.get(idx) for idx in
+                               xrange(1, max(values or [0])+1))
+            if not values:
+                results.append(None)
+            elif len(values) == 1:
+                results.append(values[0])
+            else:
+                results.append(values)
+        return results
+
+    def prepare(self, lua_code, remote_libs=[], params=(), do_return=True):
+        """ Prepare Lua code for repeated execution on the device.
+
+        >>> set_zoom = device.prepare("set_zoom(level)", params=['level'],
+        ...                           do_return=False)
+        >>> for level in xrange(10):
+        ...     set_zoom(level)
+        >>> set_zoom.stats
+        ScriptStats(calls=10, ...)
+
+        :param lua_code:    Lua code to execute
+        :type lua_code:     str/unicode
+        :param remote_libs: Additional code modules from `rlibs.lua` (see
+                            chdkptp source) that should be uploaded along with
+                            the specified code
+        :type remote_libs:  List of str/unicode with names of modules from
+                            `rlibs.lua`
+        :param params:      Names of parameters, they are available as local
+                            variables in `lua_code`
+        :type params:       List of str
+        :param do_return:   Return value of lua code
+        :type do_return:    bool
+        :rtype:             :class:`chdkptp.script.PreparedScript`
+        """
+        if do_return:
+            lua_code = _ensure_return(lua_code)
+        return PreparedScript(self, lua_code, remote_libs=remote_libs,
+                              params=params, do_return=do_return)
+
+    def wait_for_script(self, timeout=None):
+        """ Block until the script running on the device has finished.
+
+        :param timeout:     Maximum time in milliseconds to wait
+        :type timeout:      int
+        """
+        if timeout is None:
+            self._lua.call("con:wait_status", run=False)
+        else:
+            self._lua.call("con:wait_status", run=False, timeout=timeout)
+
     def kill_scripts(self, flush=True):
         """ Terminate any running script on the device.
 
@@ -204,6 +629,8 @@ class ChdkDevice(object):
         self._lua.call("con:exec", "", flush_cam_msgs=flush,
                        flush_host_msgs=flush, clobber=True)
         self._lua.call("con:wait_status", run=False)
+        if flush:
+            self._message_buffer.clear()
 
     def upload_file(self, local_path, remote_path='A/', skip_checks=False):
         """ Upload a file to the device.
@@ -236,47 +663,119 @@ class ChdkDevice(object):
                                            os.path.basename(local_path))
         self._lua.call("con:upload", local_path, remote_path)
 
-    def batch_upload(self, local_paths, remote_path='A/'):
+    def batch_upload(self, local_paths, remote_path='A/',
+                     skip_unchanged=True, manifest=None):
         """ Upload multiple files/directories to the device.
 
+        Files that already exist on the device with the same size and
+        modification time are skipped, the remote files are checked in
+        batches with a single call to the device per batch.
+
         :param local_paths:     Multiple locals paths
         :type local_paths:      collection of str/unicode
         :param remote_path:     Target path on the device
         :type remote_path:      str/unicode
+        :param skip_unchanged:  Skip files that are unchanged on the device
+        :type skip_unchanged:   bool
+        :param manifest:        (Optional) path to a local file that records
+                                checksums of the uploaded files, so that
+                                files that were only touched are skipped, too
+        :type manifest:         str/unicode
+        :return:                Uploaded and skipped files and the number of
+                                bytes saved
+        :rtype:                 :class:`chdkptp.transfer.UploadStats`
         """
-        remote_path = util.to_camerapath(remote_path)
-        local_paths = [os.path.abspath(p) for p in local_paths]
-        self._lua.call("con:mupload", self._lua.table(*local_paths),
-                       remote_path, dirs=True, mtime=True, maxdepth=100)
+        return batch_upload(self, local_paths, remote_path,
+                            skip_unchanged=skip_unchanged, manifest=manifest)
 
-    def download_file(self, remote_path, local_path=None):
+    def download_file(self, remote_path, local_path=None, offset=0,
+                      length=None):
         """ Download a single file from the device.
 
         If no local path is specified, the file's content is returned as a
-        bytestring.
+        bytestring. Where supported by the OS, the data is passed through a
+        named pipe, so it never touches the local disk.
 
         :param remote_path: Path on the device. The leading 'A/' is optional,
                             it will be automatically prepended if not
                             specified
         :type remote_path:  str/unicode
-        :param local_path:  (Optional) local path to store file under.
-        :type local_path:   str/unicode
+        :param local_path:  (Optional) local path or file object to store the
+                            file in, or a function that is called with every
+                            chunk of data and its offset.
+        :type local_path:   str/unicode/file/callable
+        :param offset:      Only return data starting at this byte offset.
+                            Note that the complete file is always transferred
+                            from the device.
+        :type offset:       int
+        :param length:      Only return up to this number of bytes
+        :type length:       int
         :return:            If `local_path` was not specified, the file content
                             as a bytestring, otherwise None
         :rtype:             str/None
         """
         remote_path = util.to_camerapath(remote_path)
-        path = local_path or tempfile.mkstemp()[1]
-        self._lua.call("con:download", remote_path, path)
-        if not local_path:
-            with open(path, 'rb') as fp:
-                rval = fp.read()
-            os.unlink(path)
-            return rval
-
-    def batch_download(self, remote_paths, local_path='./', overwrite=False):
+        partial = offset or length is not None
+        if isinstance(local_path, basestring) and not partial:
+            self._lua.call("con:download", remote_path, local_path)
+            return
+        buf = None
+        if local_path is None:
+            local_path = buf = io.BytesIO()
+        with _chunk_writer(local_path) as write:
+            self._download_chunks(remote_path, write, offset, length)
+        if buf is not None:
+            return buf.getvalue()
+
+    def _download_chunks(self, remote_path, write, offset=0, length=None):
+        tmp_dir = tempfile.mkdtemp(prefix='chdkptp-')
+        try:
+            path = os.path.join(tmp_dir, 'download')
+            if fcntl is None or not hasattr(os, 'mkfifo'):
+                self._lua.call("con:download", remote_path, path)
+                with open(path, 'rb') as fp:
+                    _copy_chunks(fp.fileno(), write, offset, length)
+                return
+            os.mkfifo(path)
+            # Open both ends of the pipe, so that neither side blocks on
+            # opening and the reader only receives EOF once the download has
+            # finished (or failed before ever opening the pipe).
+            read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(path, os.O_WRONLY)
+            fcntl.fcntl(read_fd, fcntl.F_SETFL,
+                        fcntl.fcntl(read_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            reader_errors = []
+
+            def read():
+                try:
+                    _copy_chunks(read_fd, write, offset, length)
+                except Exception:
+                    reader_errors.append(sys.exc_info())
+                    # Keep draining, otherwise the download would block
+                    _copy_chunks(read_fd, lambda data, offset: None)
+                finally:
+                    os.close(read_fd)
+            reader = threading.Thread(target=read,
+                                      name="chdkptp-download-reader")
+            reader.start()
+            try:
+                self._lua.call("con:download", remote_path, path)
+            finally:
+                os.close(write_fd)
+                reader.join()
+            if reader_errors:
+                exc_info = reader_errors[0]
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def batch_download(self, remote_paths, local_path='./', overwrite=False,
+                       order=None, progress=None):
         """ Download multiple files/directories from the device.
 
+        All files are downloaded with a single call into the chdkptp Lua
+        code that reports back after every file.
+
         :param remote_paths:    Multiple paths on the device. The leading
                                 'A/' is optional, it will be automatically
                                 prepended if not specified
@@ -285,12 +784,31 @@ class ChdkDevice(object):
         :type local_path:       str/unicode
         :param overwrite:       Overwrite existing files
         :type overwrite:        bool
+        :param order:           Order in which to download the files, one of
+                                'name', 'newest', 'oldest', 'largest',
+                                'smallest' or a key function
+        :type order:            str/callable
+        :param progress:        Function that is called with a
+                                :class:`chdkptp.transfer.DownloadResult` for
+                                every file, return `False` to stop the
+                                download
+        :type progress:         callable
+        :return:                Per-file results and throughput
+        :rtype:                 :class:`chdkptp.transfer.DownloadStats`
         """
-        remote_paths = [util.to_camerapath(p) for p in remote_paths]
-        local_path = os.path.abspath(local_path)
-        self._lua.call("con:mdownload", self._lua.table(*remote_paths),
-                       local_path, maxdepth=100, batchsize=20, dbgmem=False,
-                       overwrite=overwrite)
+        return batch_download(self, remote_paths, local_path, overwrite,
+                              order=order, progress=progress)
+
+    def iter_download(self, remote_paths, local_path='./', overwrite=False,
+                      order=None):
+        """ Download multiple files/directories from the device and yield
+            the result of every file, see :meth:`batch_download`.
+
+        :rtype:     generator, yields
+                    :class:`chdkptp.transfer.DownloadResult`
+        """
+        return iter_download(self, remote_paths, local_path, overwrite,
+                             order=order)
 
     def delete_files(self, *remote_paths):
         """ Delete one or more files/directories from the device.
@@ -302,15 +820,40 @@ class ChdkDevice(object):
         self._con.mdelete(self._con, self._lua.table(*remote_paths),
                           self._lua.table(skip_topdirs=True))
 
-    def list_files(self, remote_path='A/DCIM', detailed=False):
+    def list_files(self, remote_path='A/DCIM', detailed=False,
+                   recursive=False, pattern=None, newer_than=None):
         """ Get directory listing for a path on the device.
 
+        With `recursive=True`, the whole directory tree is walked by a single
+        script on the device, see :meth:`walk_files`.
+
         :param remote_path: Path on the device
         :type remote_path:  str/unicode
         :param detailed:    Return detailed information about each file/dir
         :type detailed:     bool
-        :return:            All files and directories in the path
+        :param recursive:   List all files below the path, directories are
+                            not included
+        :type recursive:    bool
+        :param pattern:     Only list files whose name matches this
+                            shell-style wildcard pattern (case-insensitive),
+                            only with `recursive=True`
+        :type pattern:      str/unicode
+        :param newer_than:  Only list files modified after this timestamp,
+                            only with `recursive=True`
+        :type newer_than:   int
+        :return:            All files and directories in the path, with
+                            `recursive=True` and `detailed=True` as
+                            :class:`RemoteFile` tuples
         """
+        if recursive:
+            files = self.walk_files(remote_path, pattern=pattern,
+                                    newer_than=newer_than)
+            if detailed:
+                return list(files)
+            return [f.path for f in files]
+        if pattern is not None or newer_than is not None:
+            raise ValueError("`pattern` and `newer_than` require "
+                             "`recursive=True`")
         remote_path = util.to_camerapath(remote_path)
         flist = self._lua.call("con:listdir", remote_path, dirsonly=False,
                                stat="*" if detailed else "/")
@@ -322,6 +865,84 @@ class ChdkDevice(object):
                           {k: v for k, v in info.items() if k != 'name'})
                     for info in flist.values()]
 
+    def walk_files(self, remote_path='A/DCIM', pattern=None, newer_than=None,
+                   batch_size=LIST_BATCH_SIZE, timeout=30):
+        """ Get all files below a path on the device.
+
+        The directory tree is walked by a single script on the device, which
+        applies the filters and sends the files back in batches, so listing
+        a whole card only takes one script round-trip instead of one per
+        directory. Files are yielded as soon as their batch arrives.
+
+        :param remote_path: Path on the device
+        :type remote_path:  str/unicode
+        :param pattern:     Only yield files whose name matches this
+                            shell-style wildcard pattern (case-insensitive)
+        :type pattern:      str/unicode
+        :param newer_than:  Only yield files modified after this timestamp
+        :type newer_than:   int
+        :param batch_size:  Maximum number of files per message
+        :type batch_size:   int
+        :param timeout:     Maximum time in seconds to wait for the next
+                            batch
+        :type timeout:      int/float
+        :rtype:             generator, yields :class:`RemoteFile`
+        """
+        remote_path = util.to_camerapath(remote_path).rstrip('/')
+        if pattern is not None:
+            pattern = util.glob_to_lua_pattern(pattern.lower())
+        params = (remote_path, pattern, newer_than, batch_size)
+        code = "local root, pattern, newer_than, batch_size = {0}\n{1}".format(
+            ", ".join(serialize(value) for value in params), _WALK_SCRIPT)
+        # Messages of earlier scripts would be taken for batches or the end
+        # of the listing, the ones still on the device are flushed by
+        # `con:exec`
+        self._message_buffer.clear()
+        self._execute(code, self._serialize_libs, wait=False)
+        finished = False
+        try:
+            for msg in self.stream_messages(timeout=timeout,
+                                            batch_size=batch_size):
+                if msg.type == 'user':
+                    directory = msg.value[0]
+                    for idx in xrange(1, len(msg.value), 3):
+                        yield RemoteFile(directory + '/' + msg.value[idx],
+                                         msg.value[idx+1], msg.value[idx+2])
+                    continue
+                finished = True
+                if msg.type == 'error':
+                    raise RuntimeError("Could not list files: {0}"
+                                       .format(msg.value))
+                return
+            raise RuntimeError("Timed out waiting for directory listing")
+        finally:
+            # Stop the script if the caller stopped iterating early
+            if not finished:
+                self.kill_scripts()
+
+    def sync(self, remote_dir, local_dir, delete=False, index_path=None):
+        """ Incrementally transfer files from a directory on the device.
+
+        Only files that are new or changed since the last synchronization
+        are transferred, based on a local index of the size and modification
+        time of every transferred file. The index is updated after every
+        file, so an interrupted synchronization can simply be restarted.
+        See :func:`chdkptp.sync.sync` for details.
+
+        :param remote_dir:  Directory on the device
+        :type remote_dir:   str/unicode
+        :param local_dir:   Local target directory
+        :type local_dir:    str/unicode
+        :param delete:      Delete files from the device once they have been
+                            transferred and verified
+        :type delete:       bool
+        :param index_path:  (Optional) path to the index database
+        :type index_path:   str/unicode
+        :rtype:             :class:`chdkptp.sync.SyncResult`
+        """
+        return sync(self, remote_dir, local_dir, delete=delete,
+                    index_path=index_path)
+
     def mkdir(self, remote_path):
         """ Create a directory on the device.
         Intermediate directories will be created as needed.
@@ -341,6 +962,30 @@ class ChdkDevice(object):
         """
         self._lua.call("con:reconnect", wait=wait, strict=True)
 
+    def disconnect(self):
+        """ Close the connection to the device. """
+        self._lua.call("con:disconnect")
+
+    def _detach(self):
+        """ Take the Lua runtime away from the device, so that it can be
+            used for another device. The device can not be used anymore.
+
+        :return:    The runtime, `None` if it was already taken away
+        :rtype:     :class:`chdkptp.lua.LuaContext`
+        """
+        if isinstance(self._lua, _DetachedLua):
+            return None
+        lua = self._lua
+        self._lua = _DetachedLua()
+        self._con = None
+        # Compiled functions refer to the runtime's global connection
+        self._message_reader = None
+        self._executor = None
+        self._get_mode = None
+        self._switch_mode = None
+        self._serialize_libs = None
+        return lua
+
     def reboot(self, wait=3500, bootfile=None):
         """ Reboot the device.
 
@@ -358,52 +1003,84 @@ class ChdkDevice(object):
                          clobber=True)
         self.reconnect(wait)
 
-    def get_frames(self, format='ppm', scaled=None):
+    def get_frames(self, format='ppm', scaled=None, encode_workers=None,
+                   encode_processes=False):
         """ Get a generator that yields frames from the device's viewport.
 
+        The frame grabbing code is compiled only once per generator and
+        re-uses its buffers between frames.
+
         :param format:      Target format for frames, if `None` the raw image
-                            data is returned
-        :type format:       One of 'ppm', 'jpg', 'png'
+                            data is returned as :class:`Frame` objects, for
+                            'array' a NumPy array with shape
+                            `(height, width, 3)` is returned
+        :type format:       One of 'ppm', 'jpg', 'png', 'array' or `None`
         :param scaled:      The raw image has the wrong aspect ratio, with
                             this flag this can be corrected on the device,
                             which results in some quality degradation, but
-                            is very fast.
-                            Defaults to `True` when format is 'ppm', otherwise
-                            `False`.
+                            is very fast. Otherwise the aspect ratio is
+                            corrected on the host for 'array', 'jpg' and
+                            'png'.
+                            Defaults to `True` when format is 'ppm' or
+                            `None`, otherwise `False`.
         :type scaled:       bool
-        :return:            Generator that yields bytestrings with frame data
-                            in the specified format
+        :param encode_workers:  Encode 'jpg' and 'png' frames in parallel
+                                with this many workers, frames are still
+                                returned in order
+        :type encode_workers:   int
+        :param encode_processes:    Use processes instead of threads for
+                                    parallel encoding
+        :type encode_processes:     bool
+        :return:            Generator that yields frame data in the
+                            specified format
         """
-        if format not in ('ppm', 'jpg', 'png'):
-            raise ValueError("`format` has to be one of 'ppm', 'jpg' or 'png'")
         if scaled is None:
-            scaled = (format == 'ppm')
-        while True:
-            imgdata = self._lua.eval("""
-                function(skip)
-                    local frame = con:get_live_data(nil, 1)
-                    local pimg = liveimg.get_viewport_pimg(nil, frame, skip)
-                    local lb = pimg:to_lbuf_packed_rgb(nil)
-                    local header = string.format('P6\\n%d\\n%d\\n%d\\n',
-                                                pimg:width(), pimg:height(),
-                                                255)
-                    return header .. lb:string()
-                end
-            """)(scaled)
-            if format == 'ppm':
-                yield imgdata
-            else:
-                try:
-                    from PIL import Image
-                except ImportError:
-                    raise RuntimeError(
-                        "To convert into JPEG or PNG, please install the "
-                        "`pillow` package.")
-                img = Image.open(StringIO.StringIO(imgdata))
-                width, height = img.size
-                img.resize((width/2, height))
-                imgdata = img.tobytes('PNG' if format == 'png' else 'JPEG')
+            scaled = format in ('ppm', None)
+        convert = get_converter(format, scaled=scaled)
+        frames = FrameFetcher(self._lua, scaled=scaled)
+        if encode_workers and format in ('jpg', 'png'):
+            encoder = FrameEncoder(format, scaled=scaled,
+                                   workers=encode_workers,
+                                   processes=encode_processes)
+            for imgdata in encoder.encode(frames):
                 yield imgdata
+        else:
+            for frame in frames:
+                yield convert(frame)
+
+    def prefetch_frames(self, format='ppm', scaled=None, maxsize=2,
+                        drop_oldest=True):
+        """ Fetch frames from the device's viewport in a background thread.
+
+        In contrast to :meth:`get_frames`, a slow consumer does not stall the
+        transfer from the device. Frames are buffered in a bounded queue
+        and, by default, the oldest frame is dropped when the queue is full,
+        so that the consumer always gets the most recent frames.
+
+        The returned prefetcher is already started, iterate over it to get
+        the frames and call its `stop` method (or use it as a context
+        manager) when you're done.
+
+        :param format:      Target format for frames, see :meth:`get_frames`
+        :type format:       One of 'ppm', 'jpg', 'png', 'array' or `None`
+        :param scaled:      Correct the aspect ratio on the device, see
+                            :meth:`get_frames`
+        :type scaled:       bool
+        :param maxsize:     Maximum number of buffered frames
+        :type maxsize:      int
+        :param drop_oldest: Drop the oldest frame if the queue is full,
+                            otherwise pause fetching until there is space
+        :type drop_oldest:  bool
+        :rtype:             :class:`chdkptp.liveview.FramePrefetcher`
+        """
+        if scaled is None:
+            scaled = format in ('ppm', None)
+        convert = get_converter(format, scaled=scaled)
+        prefetcher = FramePrefetcher(FrameFetcher(self._lua, scaled=scaled),
+                                     convert=convert, maxsize=maxsize,
+                                     drop_oldest=drop_oldest)
+        prefetcher.start()
+        return prefetcher
 
     def shoot(self, **kwargs):
         """ Shoot a picture
@@ -434,6 +1111,12 @@ class ChdkDevice(object):
         :param dng:             Dump raw framebuffer in DNG format
                                 (default: False)
         :type dng:              boolean
+        :param raw_array:       Return the raw sensor data as a NumPy
+                                `uint16` array with shape `(height, width)`
+                                instead of a DNG file. Only for
+                                `stream=True` and without `output`.
+                                (default: False)
+        :type raw_array:        boolean
         :param wait:            Wait for capture to complete (default: True)
         :type wait:             boolean
         :param download_after:  Download and return image data after capture
@@ -446,10 +1129,26 @@ class ChdkDevice(object):
                                 device (will not be saved on camera storage)
                                 (default: True)
         :type stream:           boolean
+        :param output:          Where to write the streamed image data to,
+                                either a local path, a file object or a
+                                function that is called with every chunk
+                                of data and its offset in the file. The
+                                chunks are written as soon as they arrive,
+                                so the image is never held in memory as a
+                                whole. If not specified, the data is
+                                returned. Only for `stream=True`.
+                                (default: None)
+        :type output:           str/unicode/file/callable
+        :return:                The image data if `output` was not
+                                specified, otherwise None
         """
+        if kwargs.get('raw_array', False) and (
+                not kwargs.get('stream', True) or
+                kwargs.get('output') is not None):
+            raise ValueError("`raw_array` requires `stream=True` and no "
+                             "`output`")
         self._validate_shoot_args()
-        options = self._lua.globals.util.serialize(
-            self._lua.table(**self._parse_shoot_args(**kwargs)))
+        options = self._serialize_shoot_args(**kwargs)
 
         if not kwargs.get('stream', True):
             return self._shoot_nonstreaming(
@@ -457,7 +1156,10 @@ class ChdkDevice(object):
                 download=kwargs.get('download_after', False),
                 remove=kwargs.get('remove_after', False))
         else:
-            return self._shoot_streaming(options, dng=kwargs.get('dng', False))
+            return self._shoot_streaming(
+                options, dng=kwargs.get('dng', False),
+                output=kwargs.get('output', None),
+                raw_array=kwargs.get('raw_array', False))
 
     def _shoot_nonstreaming(self, options, wait=True, download=False,
                             remove=False):
@@ -468,6 +1170,9 @@ class ChdkDevice(object):
         status = self.lua_execute(
             "return rlib_shoot(%s)" % options,
             remote_libs=['serialize_msgs', 'rlib_shoot'])
+        return self._fetch_capture(status, download=download, remove=remove)
+
+    def _fetch_capture(self, status, download=False, remove=False):
         # TODO: Check for errors
         img_path = "{0}/IMG_{1:04}.JPG".format(status['dir'], status['exp'])
         rval = None
@@ -477,74 +1182,193 @@ class ChdkDevice(object):
             self.delete_files(img_path)
         return rval
 
-    def _shoot_streaming(self, options, dng=False):
+    def shooting_session(self, timeout=30):
+        """ Get a session that keeps a shooting script running on the device.
+
+        Use this if you want to shoot many pictures with `stream=False`,
+        since the shooting libraries then only have to be uploaded to the
+        device once::
+
+            with device.shooting_session() as session:
+                for i in xrange(10):
+                    data = session.shoot(download_after=True,
+                                         remove_after=True)
+
+        :param timeout:     Maximum time in seconds to wait for a shot
+        :type timeout:      int/float
+        :rtype:             :class:`chdkptp.session.ShootingSession`
+        """
+        return ShootingSession(self, timeout=timeout)
+
+    def shoot_sequence(self, count, interval=None, get_output=None,
+                       **kwargs):
+        """ Shoot a sequence of pictures and stream them from the device.
+
+        The shooting script is started only once for the whole sequence and
+        the device begins with the next exposure as soon as the data of the
+        previous one has been handed over, so shooting and transferring
+        overlap.
+
+        :param count:       Number of pictures to shoot
+        :type count:        int
+        :param interval:    Minimum time between two shots in milliseconds
+        :type interval:     int
+        :param get_output:  Function that is called with the index of every
+                            shot and returns where its data should be
+                            written to, see the `output` argument of
+                            :meth:`shoot`. If not specified, the data is
+                            returned in the results.
+        :type get_output:   callable
+        :param kwargs:      Capture settings, see :meth:`shoot`.
+                            `stream`, `wait`, `download_after`,
+                            `remove_after` and `output` are not supported.
+        :return:            Generator that yields a :class:`ShotResult` for
+                            every shot
+        """
+        if count < 1:
+            raise ValueError("`count` must be at least 1")
+        for arg in ('stream', 'wait', 'download_after', 'remove_after',
+                    'output'):
+            if arg in kwargs:
+                raise ValueError("`{0}` is not supported for sequences"
+                                 .format(arg))
+        if kwargs.get('raw_array', False) and get_output is not None:
+            raise ValueError("`raw_array` cannot be used with `get_output`")
+        self._validate_shoot_args(**kwargs)
+        shoot_args = self._parse_shoot_args(**kwargs)
+        shoot_args['shots'] = count
+        if interval is not None:
+            shoot_args['int'] = interval
+        options = self._lua.globals.util.serialize(
+            self._lua.table(**shoot_args))
+        self._start_remote_shoot(options)
+        finished = False
+        try:
+            for idx in xrange(count):
+                output = get_output(idx) if get_output else None
+                start = time.time()
+                data, first_chunk = self._get_capture_data(
+                    dng=kwargs.get('dng', False), output=output,
+                    raw_array=kwargs.get('raw_array', False))
+                end = time.time()
+                yield ShotResult(index=idx, data=data,
+                                 wait_time=first_chunk - start,
+                                 transfer_time=end - first_chunk)
+            finished = True
+        finally:
+            if not finished:
+                self.kill_scripts()
+            self._finish_remote_shoot()
+
+    def _start_remote_shoot(self, options):
         self.lua_execute(
             "return rs_init(%s)" % options, remote_libs=['rs_shoot_init'])
         # TODO: Check for errors
         self.lua_execute("rs_shoot(%s)" % options,
                          remote_libs=['rs_shoot'], wait=False)
-        rcopts = {}
-        img_data = self._lua.table()
-        if dng:
-            dng_info = self._lua.table(lstart=0, lcount=0, badpix=0)
-            rcopts['dng_hdr'] = self._lua.globals.chdku.rc_handler_store(
-                self._lua.eval("""
-                function(dng_info)
-                    return function(chunk)
-                        dng_info.hdr=chunk.data
-                    end
-                end
-                """)(dng_info))
-            rcopts['raw'] = self._lua.eval("""
-                function(dng_info, img_data)
-                    return function(lcon, hdata)
-                        local status, raw = lcon:capture_get_chunk_pcall(
-                            hdata.id)
-                        if not status then
-                            return false, raw
-                        end
-                        table.insert(img_data, {data=dng_info.hdr})
-                        local status, err = chdku.rc_process_dng(dng_info,
-                                                                raw)
-                        if status then
-                            table.insert(img_data, {data=dng_info.thumb})
-                            table.insert(img_data, raw)
-                        end
-                        return status, err
-                    end
-                end
-                """)(dng_info, img_data)
-        else:
-            rcopts['jpg'] = self._lua.globals.chdku.rc_handler_store(
-                img_data)
-        self._con.capture_get_data_pcall(
-            self._con, self._lua.table(**rcopts))
+
+    def _finish_remote_shoot(self):
         self._con.wait_status_pcall(
             self._con, self._lua.table(run=False, timeout=30000))
         # TODO: Check for error
         # TODO: Check for timeout
         self.lua_execute('init_usb_capture(0)')
-        # NOTE: We can't touch the chunk data from Python or else the
-        # Lua runtime segfaults, so we let Lua take care of assembling
-        # the output data
-        return self._lua.eval("""
-            function(chunks)
-                local size = 0
-                for i, c in ipairs(chunks) do
-                    size = size + c.size
-                end
-                local buf = lbuf.new(size)
-                local offset = 0
-                for i, c in ipairs(chunks) do
-                    if c.offset ~= nil then
-                        offset = c.offset
+
+    def _get_capture_data(self, dng=False, output=None, raw_array=False):
+        """ Fetch the data of a single remote capture.
+
+        :return:    The data if no `output` was specified, otherwise `None`,
+                    and the time at which the first chunk arrived
+        """
+        first_chunk = []
+        if dng or raw_array:
+            # Only the raw chunks are fetched in Lua, the DNG is assembled on
+            # the host, see chdkptp.raw
+            dng_info = self._lua.table()
+            rcopts = {
+                'dng_hdr': self._lua.globals.chdku.rc_handler_store(
+                    self._lua.eval("""
+                    function(dng_info, received)
+                        return function(chunk)
+                            received()
+                            dng_info.hdr = chunk.data:string()
+                        end
+                    end
+                    """)(dng_info,
+                          lambda: first_chunk.append(time.time()))),
+                'raw': self._lua.eval("""
+                    function(dng_info)
+                        return function(lcon, hdata)
+                            local status, raw = lcon:capture_get_chunk_pcall(
+                                hdata.id)
+                            if not status then
+                                return false, raw
+                            end
+                            dng_info.raw = raw.data:string()
+                            return true
+                        end
+                    end
+                    """)(dng_info)}
+            self._lua._parse_rval(self._con.capture_get_data_pcall(
+                self._con, self._lua.table(**rcopts)))
+            received = first_chunk[0] if first_chunk else time.time()
+            if raw_array:
+                info = raw.parse_dng_header(dng_info.hdr)
+                return (raw.unpack_raw(dng_info.raw, info.width, info.height,
+                                       info.bpp),
+                        received)
+            buf = None
+            if output is None:
+                output = buf = io.BytesIO()
+            with _chunk_writer(output) as write:
+                raw.write_dng(write, dng_info.hdr, dng_info.raw)
+            return buf.getvalue() if buf is not None else None, received
+        buf = None
+        if output is None:
+            output = buf = io.BytesIO()
+        with _chunk_writer(output) as write_chunk:
+            def write(data, offset):
+                if not first_chunk:
+                    first_chunk.append(time.time())
+                write_chunk(data, offset)
+            handler = self._lua.eval("""
+                function(write)
+                    return function(lcon, hdata)
+                        local offset = 0
+                        repeat
+                            local status, chunk =
+                                lcon:capture_get_chunk_pcall(hdata.id)
+                            if not status then
+                                return false, chunk
+                            end
+                            if chunk.offset ~= nil then
+                                offset = chunk.offset
+                            end
+                            write(chunk.data:string(), offset)
+                            offset = offset + chunk.size
+                        until chunk.last
+                        return true
                     end
-                    buf:fill(c.data, offset, 1)
-                    offset = offset + c.size
                 end
-                return buf:string()
-            end
-            """)(img_data)
+                """)(write)
+            self._lua._parse_rval(self._con.capture_get_data_pcall(
+                self._con, self._lua.table(jpg=handler)))
+        return (buf.getvalue() if buf is not None else None,
+                first_chunk[0] if first_chunk else time.time())
+
+    def _shoot_streaming(self, options, dng=False, output=None,
+                         raw_array=False):
+        self._start_remote_shoot(options)
+        try:
+            data, _ = self._get_capture_data(dng=dng, output=output,
+                                             raw_array=raw_array)
+        finally:
+            self._finish_remote_shoot()
+        return data
+
+    def _serialize_shoot_args(self, **kwargs):
+        return self._lua.globals.util.serialize(
+            self._lua.table(**self._parse_shoot_args(**kwargs)))
 
     def _validate_shoot_args(self, **kwargs):
         for arg in ('shutter_speed', 'real_iso', 'market_iso', 'aperture',
@@ -602,12 +1426,13 @@ class ChdkDevice(object):
                 options['sd'] = round(DISTANCE_FACTORS[unit]*float(value))
             else:
                 options['sd'] = round(kwargs.get('distance', None))
-        if kwargs.get('dng', False):
+        dng = kwargs.get('dng', False) or kwargs.get('raw_array', False)
+        if dng:
             options['dng'] = 1
-        if kwargs.get('dng', False) or kwargs.get('raw', False):
+        if dng or kwargs.get('raw', False):
             options['raw'] = 1
         if kwargs.get('stream', True):
-            if kwargs.get('dng', False):
+            if dng:
                 options['fformat'] = 6
             elif kwargs.get('raw', False):
                 options['fformat'] = 4
@@ -0,0 +1,146 @@
+""" Conversions between exposure values and CHDK's APEX96 units.
+
+The results are identical to those of chdkptp's `exposure` Lua module, but
+the conversions run without a Lua runtime. The `*_array` variants accept
+and return NumPy arrays, the scalar functions use precomputed tables for
+the standard third-stop ladders.
+"""
+import math
+
+import chdkptp.util as util
+
+#: Offset between the APEX96 values of Canon's 'market' and 'real' ISO
+SV96_MARKET_OFFSET = 69
+
+#: Standard ISO values in third stops
+ISO_LADDER = (50, 64, 80, 100, 125, 160, 200, 250, 320, 400, 500, 640, 800,
+              1000, 1250, 1600, 2000, 2500, 3200, 4000, 5000, 6400, 8000,
+              10000, 12800)
+#: Standard shutter speeds in seconds in third stops
+SHUTTER_LADDER = (
+    30, 25, 20, 15, 13, 10, 8, 6, 5, 4, 3.2, 2.5, 2, 1.6, 1.3, 1, 0.8, 0.6,
+    0.5, 0.4, 0.3, 1/4., 1/5., 1/6., 1/8., 1/10., 1/13., 1/15., 1/20.,
+    1/25., 1/30., 1/40., 1/50., 1/60., 1/80., 1/100., 1/125., 1/160.,
+    1/200., 1/250., 1/320., 1/400., 1/500., 1/640., 1/800., 1/1000.,
+    1/1250., 1/1600., 1/2000., 1/2500., 1/3200., 1/4000.)
+#: Standard f-numbers in third stops
+APERTURE_LADDER = (1.0, 1.1, 1.2, 1.4, 1.6, 1.8, 2.0, 2.2, 2.5, 2.8, 3.2,
+                   3.5, 4.0, 4.5, 5.0, 5.6, 6.3, 7.1, 8.0, 9.0, 10.0, 11.0,
+                   13.0, 14.0, 16.0, 18.0, 20.0, 22.0, 25.0, 29.0, 32.0)
+
+_LOG2 = math.log(2)
+
+
+def _log2(x):
+    return math.log(x)/_LOG2
+
+
+def _round(x):
+    # Round half away from zero, like `util.round` in chdkptp
+    return int(math.floor(x + 0.5)) if x > 0 else int(math.ceil(x - 0.5))
+
+
+def _iso_to_sv96(iso):
+    return _round(96*_log2(iso/3.125))
+
+
+def _shutter_to_tv96(shutter_speed):
+    return _round(-96*_log2(shutter_speed))
+
+
+def _aperture_to_av96(aperture):
+    return _round(192*_log2(aperture))
+
+
+ISO_TO_SV96 = dict((iso, _iso_to_sv96(iso)) for iso in ISO_LADDER)
+SHUTTER_TO_TV96 = dict((s, _shutter_to_tv96(s)) for s in SHUTTER_LADDER)
+APERTURE_TO_AV96 = dict((f, _aperture_to_av96(f)) for f in APERTURE_LADDER)
+
+
+def iso_to_sv96(iso):
+    """ Convert a 'real' ISO value to APEX96. """
+    sv96 = ISO_TO_SV96.get(iso)
+    return sv96 if sv96 is not None else _iso_to_sv96(iso)
+
+
+def sv96_to_iso(sv96):
+    """ Convert an APEX96 speed value to 'real' ISO. """
+    return 3.125*2**(sv96/96.)
+
+
+def iso_market_to_sv96(iso):
+    """ Convert a 'market' ISO value, as shown in the Canon UI, to the
+        APEX96 value of the corresponding 'real' ISO.
+    """
+    return iso_to_sv96(iso) - SV96_MARKET_OFFSET
+
+
+def shutter_to_tv96(shutter_speed):
+    """ Convert a shutter speed in seconds to APEX96. """
+    tv96 = SHUTTER_TO_TV96.get(shutter_speed)
+    return tv96 if tv96 is not None else _shutter_to_tv96(shutter_speed)
+
+
+def tv96_to_shutter(tv96):
+    """ Convert an APEX96 time value to a shutter speed in seconds. """
+    return 1/2**(tv96/96.)
+
+
+def aperture_to_av96(aperture):
+    """ Convert an f-number to APEX96. """
+    av96 = APERTURE_TO_AV96.get(aperture)
+    return av96 if av96 is not None else _aperture_to_av96(aperture)
+
+
+def av96_to_aperture(av96):
+    """ Convert an APEX96 aperture value to an f-number. """
+    return math.sqrt(2**(av96/96.))
+
+
+def _round_array(x):
+    numpy = util.import_numpy()
+    return numpy.where(x > 0, numpy.floor(x + 0.5),
+                       numpy.ceil(x - 0.5)).astype(numpy.int64)
+
+
+def iso_to_sv96_array(isos):
+    """ Vectorized :func:`iso_to_sv96`.
+
+    :type isos:     :class:`numpy.ndarray` or sequence
+    :rtype:         :class:`numpy.ndarray` of `int64`
+    """
+    numpy = util.import_numpy()
+    return _round_array(
+        96*numpy.log(numpy.asarray(isos, dtype=float)/3.125)/_LOG2)
+
+
+def sv96_to_iso_array(sv96s):
+    """ Vectorized :func:`sv96_to_iso`. """
+    numpy = util.import_numpy()
+    return 3.125*numpy.exp2(numpy.asarray(sv96s, dtype=float)/96)
+
+
+def shutter_to_tv96_array(shutter_speeds):
+    """ Vectorized :func:`shutter_to_tv96`. """
+    numpy = util.import_numpy()
+    return _round_array(
+        -96*numpy.log(numpy.asarray(shutter_speeds, dtype=float))/_LOG2)
+
+
+def tv96_to_shutter_array(tv96s):
+    """ Vectorized :func:`tv96_to_shutter`. """
+    numpy = util.import_numpy()
+    return 1/numpy.exp2(numpy.asarray(tv96s, dtype=float)/96)
+
+
+def aperture_to_av96_array(apertures):
+    """ Vectorized :func:`aperture_to_av96`. """
+    numpy = util.import_numpy()
+    return _round_array(
+        192*numpy.log(numpy.asarray(apertures, dtype=float))/_LOG2)
+
+
+def av96_to_aperture_array(av96s):
+    """ Vectorized :func:`av96_to_aperture`. """
+    numpy = util.import_numpy()
+    return numpy.sqrt(numpy.exp2(numpy.asarray(av96s, dtype=float)/96))
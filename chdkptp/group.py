@@ -0,0 +1,212 @@
+""" Controlling multiple devices concurrently. """
+import Queue
+import sys
+import threading
+import time
+from collections import namedtuple
+
+GroupResult = namedtuple("GroupResult", ('device', 'value', 'error',
+                                         'duration'))
+
+
+class Job(object):
+    """ A function call that was submitted to a :class:`DeviceWorker`. """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exc_info = None
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def duration(self):
+        """ Time in seconds it took to run the job. """
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.finished = time.time()
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """ Call a function with the job as its argument once the job is
+            done. If it already is, the function is called immediately.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """ Wait for the job to finish and return its result or raise its
+            exception.
+
+        :param timeout:     Maximum time in seconds to wait
+        :type timeout:      float
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for job.")
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class DeviceWorker(object):
+    """ Runs functions for a single device sequentially in a dedicated
+        thread.
+    """
+    def __init__(self, device):
+        self.device = device
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+                                        name="chdkptp-device-worker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, func, *args, **kwargs):
+        """ Run a function in the worker thread.
+
+        :param func:    Function to run
+        :type func:     callable
+        :rtype:         :class:`Job`
+        """
+        job = Job(func, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def stop(self, wait=True):
+        """ Stop the worker after all pending jobs are done. """
+        self._queue.put(None)
+        if wait and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class DeviceGroup(object):
+    """ Group of devices that are controlled concurrently.
+
+    Every device gets its own worker thread, so operations on different
+    devices run in parallel, while operations on the same device are run
+    one after the other. Errors are collected for every device and do not
+    affect the other devices in the group.
+    """
+    def __init__(self, devices):
+        """ Create a new group.
+
+        :param devices:     Devices in the group
+        :type devices:      Collection of :class:`chdkptp.ChdkDevice`
+        """
+        self.devices = list(devices)
+        self._workers = [DeviceWorker(dev) for dev in self.devices]
+
+    def call(self, func, *args, **kwargs):
+        """ Call a function with every device as its first argument.
+
+        :param func:    Function to call
+        :type func:     callable
+        :return:        Results in the order of the devices
+        :rtype:         list of :class:`GroupResult`
+        """
+        jobs = [worker.submit(func, worker.device, *args, **kwargs)
+                for worker in self._workers]
+        return [self._collect(job, worker.device)
+                for job, worker in zip(jobs, self._workers)]
+
+    def call_synchronized(self, func, *args, **kwargs):
+        """ Like :meth:`call`, but the function is only called once all
+            workers are idle, so that it is started on all devices at (very
+            nearly) the same time. The reported durations include the time
+            spent waiting for the other devices.
+        """
+        ready = threading.Semaphore(0)
+        go = threading.Event()
+
+        def synchronized(device, *args, **kwargs):
+            ready.release()
+            go.wait()
+            return func(device, *args, **kwargs)
+        jobs = [worker.submit(synchronized, worker.device, *args, **kwargs)
+                for worker in self._workers]
+        for _ in self._workers:
+            ready.acquire()
+        go.set()
+        return [self._collect(job, worker.device)
+                for job, worker in zip(jobs, self._workers)]
+
+    def _collect(self, job, device):
+        try:
+            value, error = job.wait(), None
+        except Exception as exc:
+            value, error = None, exc
+        return GroupResult(device=device, value=value, error=error,
+                           duration=job.duration)
+
+    def shoot(self, **kwargs):
+        """ Shoot a picture on all devices at the same time.
+
+        :param kwargs:  Capture settings, see
+                        :meth:`chdkptp.ChdkDevice.shoot`
+        :rtype:         list of :class:`GroupResult`
+        """
+        return self.call_synchronized(
+            lambda dev, **kwargs: dev.shoot(**kwargs), **kwargs)
+
+    def download_file(self, remote_path, local_path=None):
+        """ Download a file from all devices, see
+            :meth:`chdkptp.ChdkDevice.download_file`.
+
+        :param local_path:  If specified, a function that is called with each
+                            device and returns the local path or file object
+                            for it.
+        :type local_path:   callable
+        :rtype:             list of :class:`GroupResult`
+        """
+        return self.call(
+            lambda dev: dev.download_file(
+                remote_path, local_path(dev) if local_path else None))
+
+    def list_files(self, remote_path='A/DCIM', detailed=False, **kwargs):
+        """ List files on all devices, see
+            :meth:`chdkptp.ChdkDevice.list_files`.
+
+        :rtype:     list of :class:`GroupResult`
+        """
+        return self.call(lambda dev: dev.list_files(remote_path, detailed,
+                                                    **kwargs))
+
+    def close(self):
+        """ Stop all worker threads. """
+        for worker in self._workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,424 @@
+""" Helpers for grabbing frames from the device's live view. """
+import multiprocessing
+import StringIO
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+
+import chdkptp.util as util
+
+PrefetchStats = namedtuple("PrefetchStats", ('fetched', 'delivered',
+                                             'dropped', 'fetch_time',
+                                             'convert_time'))
+
+FRAME_FORMATS = (None, 'ppm', 'jpg', 'png', 'array')
+
+
+class Frame(object):
+    """ A single RGB frame from the live view.
+
+    The frame keeps a reference to the buffer received from the Lua runtime
+    and only creates views on it, so no copies are made on the Python side
+    unless a different representation is requested. Getting the buffer from
+    the runtime still copies the pixel data, see :class:`FrameFetcher`.
+    """
+    __slots__ = ('width', 'height', '_buf', '_offset')
+
+    def __init__(self, width, height, data, offset=0):
+        """ Create a new frame.
+
+        :param width:   Width of the frame in pixels
+        :type width:    int
+        :param height:  Height of the frame in pixels
+        :type height:   int
+        :param data:    Buffer with packed 8-bit RGB pixel data
+        :type data:     str/bytearray
+        :param offset:  Offset of the pixel data in `data`
+        :type offset:   int
+        """
+        self.width = width
+        self.height = height
+        self._buf = data
+        self._offset = offset
+
+    @property
+    def data(self):
+        """ Read-only view on the packed RGB pixel data.
+
+        :rtype:     :class:`memoryview`
+        """
+        view = memoryview(self._buf)
+        if self._offset:
+            view = view[self._offset:]
+        return view
+
+    @property
+    def ppm_header(self):
+        return 'P6\n{0}\n{1}\n255\n'.format(self.width, self.height)
+
+    def to_ppm(self):
+        """ Get the frame as a binary PPM image.
+
+        :rtype:     str
+        """
+        data = self._buf[self._offset:] if self._offset else self._buf
+        return self.ppm_header + str(data)
+
+    def to_array(self):
+        """ Get a view on the frame as a NumPy array, without copying.
+
+        :return:    Read-only array with shape `(height, width, 3)`
+        :rtype:     :class:`numpy.ndarray` of `uint8`
+        """
+        numpy = util.import_numpy()
+        return numpy.frombuffer(
+            self._buf, dtype=numpy.uint8, count=self.width*self.height*3,
+            offset=self._offset).reshape(self.height, self.width, 3)
+
+    def __len__(self):
+        return len(self._buf) - self._offset
+
+    def __repr__(self):
+        return "<Frame {0}x{1}>".format(self.width, self.height)
+
+
+def correct_aspect(array, interpolate=True):
+    """ Correct the aspect ratio of an unscaled live view frame by halving
+        its width.
+
+    :param array:       Frame with shape `(height, width, 3)`
+    :type array:        :class:`numpy.ndarray` of `uint8`
+    :param interpolate: Average every pair of adjacent columns instead of
+                        dropping every other column. Dropping is equivalent
+                        to scaling on the device and returns a view, while
+                        averaging has to allocate a new array but gives
+                        better quality.
+    :type interpolate:  bool
+    :rtype:             :class:`numpy.ndarray` of `uint8`
+    """
+    if not interpolate:
+        return array[:, ::2]
+    numpy = util.import_numpy()
+    width = array.shape[1] - array.shape[1] % 2
+    out = array[:, 0:width:2].astype(numpy.uint16)
+    out += array[:, 1:width:2]
+    out >>= 1
+    return out.astype(numpy.uint8)
+
+
+def encode_array(array, format, **options):
+    """ Encode an RGB array as a JPEG or PNG image.
+
+    :param array:   Image with shape `(height, width, 3)`
+    :type array:    :class:`numpy.ndarray` of `uint8`
+    :param format:  Target format
+    :type format:   One of 'jpg', 'png'
+    :param options: Additional options for the encoder, e.g. `quality`
+    :rtype:         str
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError(
+            "To convert into JPEG or PNG, please install the "
+            "`pillow` package.")
+    buf = StringIO.StringIO()
+    Image.fromarray(array, 'RGB').save(
+        buf, 'PNG' if format == 'png' else 'JPEG', **options)
+    return buf.getvalue()
+
+
+class FrameFetcher(object):
+    """ Compiled live view fetcher for a single device.
+
+    The Lua function that grabs and converts the frames is compiled once and
+    keeps its frame, image and output buffers around between invocations,
+    so they are only re-allocated when the viewport dimensions change.
+
+    The chdkptp `lbuf` cannot be accessed from Python directly, so every
+    frame is still copied into a new Lua string with `lbuf:string()` and
+    from there into a Python string.
+    """
+    def __init__(self, lua, scaled=True):
+        """ Create a new fetcher.
+
+        :param lua:     Lua context with a connected `con` object
+        :type lua:      :class:`chdkptp.lua.LuaContext`
+        :param scaled:  Correct the aspect ratio on the device
+        :type scaled:   bool
+        """
+        self._fetch = lua.eval("""
+            function(skip)
+                local frame, pimg, lb
+                return function()
+                    frame = con:get_live_data(frame, 1)
+                    pimg = liveimg.get_viewport_pimg(pimg, frame, skip)
+                    lb = pimg:to_lbuf_packed_rgb(lb)
+                    return lb:string(), pimg:width(), pimg:height()
+                end
+            end
+        """)(scaled)
+
+    def __call__(self):
+        """ Fetch the next frame.
+
+        :rtype:     :class:`Frame`
+        """
+        data, width, height = self._fetch()
+        return Frame(width, height, data)
+
+    def __iter__(self):
+        while True:
+            yield self()
+
+
+def get_converter(format, scaled=True):
+    """ Get a function that converts a :class:`Frame` to the given format.
+
+    :param format:  Target format, if `None` frames are passed through,
+                    'array' returns :class:`numpy.ndarray` objects
+    :type format:   One of 'ppm', 'jpg', 'png', 'array' or `None`
+    :param scaled:  Whether the frames were already scaled on the device,
+                    if not, the aspect ratio is corrected on the host for
+                    'array', 'jpg' and 'png'
+    :type scaled:   bool
+    :rtype:         callable
+    """
+    if format not in FRAME_FORMATS:
+        raise ValueError("`format` has to be one of 'ppm', 'jpg', 'png', "
+                         "'array' or None")
+    if format is None:
+        return lambda frame: frame
+    elif format == 'ppm':
+        return Frame.to_ppm
+
+    def to_array(frame):
+        array = frame.to_array()
+        if not scaled:
+            array = correct_aspect(array)
+        return array
+    if format == 'array':
+        return to_array
+    return lambda frame: encode_array(to_array(frame), format)
+
+
+def _encode_raw(args):
+    # Module-level, so it can be used with a process pool
+    width, height, data, scaled, format = args
+    return get_converter(format, scaled=scaled)(Frame(width, height, data))
+
+
+class FrameEncoder(object):
+    """ Encodes frames to JPEG or PNG in a pool of worker threads or
+        processes while preserving their order.
+    """
+    def __init__(self, format='jpg', scaled=True, workers=None,
+                 processes=False, max_pending=None):
+        """ Create a new encoder.
+
+        :param format:      Target format
+        :type format:       One of 'jpg', 'png'
+        :param scaled:      Whether the frames were already scaled on the
+                            device
+        :type scaled:       bool
+        :param workers:     Number of workers, defaults to the number of CPUs
+        :type workers:      int
+        :param processes:   Use worker processes instead of threads. The
+                            encoders release the GIL for most of their work,
+                            so threads are usually sufficient and avoid
+                            having to copy the frames to the workers.
+        :type processes:    bool
+        :param max_pending: Maximum number of frames that are being encoded
+                            at the same time, defaults to twice the number of
+                            workers
+        :type max_pending:  int
+        """
+        if format not in ('jpg', 'png'):
+            raise ValueError("`format` has to be one of 'jpg' or 'png'")
+        # Fail early if the dependencies are missing
+        util.import_numpy()
+        self.format = format
+        self.scaled = scaled
+        self.workers = workers or multiprocessing.cpu_count()
+        self.processes = processes
+        self.max_pending = max_pending or 2*self.workers
+
+    def encode(self, frames):
+        """ Encode frames in parallel.
+
+        :param frames:  :class:`Frame` objects to encode
+        :type frames:   iterable
+        :return:        Generator that yields the encoded frames in the order
+                        of the input frames
+        """
+        if self.processes:
+            pool = multiprocessing.Pool(self.workers)
+            convert = _encode_raw
+            prepare = lambda f: (f.width, f.height, f.data.tobytes(),
+                                 self.scaled, self.format)
+        else:
+            pool = ThreadPool(self.workers)
+            convert = get_converter(self.format, scaled=self.scaled)
+            prepare = lambda f: f
+        pending = deque()
+        try:
+            for frame in frames:
+                pending.append(pool.apply_async(convert, (prepare(frame),)))
+                if len(pending) >= self.max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class FramePrefetcher(object):
+    """ Fetches and converts frames in a background thread.
+
+    Frames are put into a bounded queue, when the consumer can't keep up
+    either the oldest frame is dropped (the default) or fetching is paused
+    until there is space in the queue again.
+    """
+    def __init__(self, fetch, convert=None, maxsize=2, drop_oldest=True):
+        """ Create a new prefetcher, call :meth:`start` to begin fetching.
+
+        :param fetch:       Function that returns the next frame, e.g. a
+                            :class:`FrameFetcher`
+        :type fetch:        callable
+        :param convert:     Optional function that is applied to every frame
+                            in the background thread
+        :type convert:      callable
+        :param maxsize:     Maximum number of frames in the queue
+        :type maxsize:      int
+        :param drop_oldest: Drop the oldest frame when the queue is full,
+                            otherwise block until a frame was consumed
+        :type drop_oldest:  bool
+        """
+        if maxsize < 1:
+            raise ValueError("`maxsize` must be at least 1")
+        self._fetch = fetch
+        self._convert = convert
+        self._drop_oldest = drop_oldest
+        self._maxsize = maxsize
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._exc_info = None
+        self._fetched = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._fetch_time = 0.0
+        self._convert_time = 0.0
+
+    @property
+    def stats(self):
+        """ Counters for fetched, delivered and dropped frames as well as
+            the mean fetch and conversion latency in seconds.
+
+        :rtype:     :class:`PrefetchStats`
+        """
+        with self._cond:
+            num = self._fetched or 1
+            return PrefetchStats(self._fetched, self._delivered,
+                                 self._dropped, self._fetch_time/num,
+                                 self._convert_time/num)
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="chdkptp-frame-prefetcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                start = time.time()
+                frame = self._fetch()
+                fetched = time.time()
+                if self._convert is not None:
+                    frame = self._convert(frame)
+                converted = time.time()
+            except Exception:
+                with self._cond:
+                    self._exc_info = sys.exc_info()
+                    self._running = False
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._fetched += 1
+                self._fetch_time += fetched - start
+                self._convert_time += converted - fetched
+                while (self._running and not self._drop_oldest and
+                       len(self._queue) >= self._maxsize):
+                    self._cond.wait()
+                if not self._running:
+                    return
+                if len(self._queue) >= self._maxsize:
+                    self._queue.popleft()
+                    self._dropped += 1
+                self._queue.append(frame)
+                self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """ Get the oldest frame from the queue.
+
+        :param timeout: Maximum time in seconds to wait for a frame
+        :type timeout:  float
+        :return:        The frame or `None` if the prefetcher was stopped
+                        or the timeout expired
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._queue and self._running:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+                else:
+                    # Waiting with a timeout keeps the thread interruptible
+                    self._cond.wait(1)
+            if self._exc_info is not None and not self._queue:
+                exc_info, self._exc_info = self._exc_info, None
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if not self._queue:
+                return None
+            frame = self._queue.popleft()
+            self._delivered += 1
+            self._cond.notify_all()
+            return frame
+
+    def __iter__(self):
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
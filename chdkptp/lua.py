@@ -1,6 +1,8 @@
 import logging
 import numbers
 import os
+import threading
+from collections import Mapping, OrderedDict, Sequence, namedtuple
 
 import lupa
 
@@ -8,6 +10,9 @@ CHDKPTP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                             'vendor', 'chdkptp')
 logger = logging.getLogger('chdkptp.lua')
 
+CallCacheInfo = namedtuple("CallCacheInfo", ('hits', 'misses', 'maxsize',
+                                             'currsize'))
+
 
 class PTPError(Exception):
     def __init__(self, err_table):
@@ -43,20 +48,61 @@ class LuaContext(object):
                 rval = rval[1]
         return rval or None
 
+    def _get_call_wrapper(self, funcname):
+        """ Get the compiled `pcall` wrapper for a function, compiling and
+            caching it if necessary.
+        """
+        fn = self._call_cache.pop(funcname, None)
+        if fn is not None:
+            self.call_cache_hits += 1
+        else:
+            self.call_cache_misses += 1
+            if ":" in funcname:
+                obj = funcname.split(':')[0]
+                unbound_name = funcname.replace(':', '.')
+                fn = self.eval("function(...) return pcall(%s, %s, ...) end"
+                               % (unbound_name, obj))
+            else:
+                fn = self.eval("function(...) return pcall(%s, ...) end"
+                               % funcname)
+        if self._call_cache_size > 0:
+            # Evict the least recently used wrapper if the cache is full,
+            # (re-)inserting marks the wrapper as the most recently used one
+            if len(self._call_cache) >= self._call_cache_size:
+                self._call_cache.popitem(last=False)
+            self._call_cache[funcname] = fn
+        return fn
+
     def call(self, funcname, *args, **kwargs):
+        """ Call a Lua function inside of `pcall`.
+
+        The compiled wrappers are cached per function name, so repeated
+        calls do not have to go through the Lua compiler again.
+
+        :param funcname:    Name of the function, methods can be called
+                            with the `obj:method` notation
+        :type funcname:     str/unicode
+        """
         args = list(args)
-        if ":" in funcname:
-            obj = funcname.split(':')[-0]
-            unbound_name = funcname.replace(':', '.')
-            fn = self.eval("function(...) return pcall(%s, %s, ...) end"
-                           % (unbound_name, obj))
-        else:
-            fn = self.eval("function(...) return pcall(%s, ...) end"
-                           % funcname)
+        fn = self._get_call_wrapper(funcname)
         if kwargs:
             args.append(self.table(**kwargs))
         return self._parse_rval(fn(*args))
 
+    def call_cache_info(self):
+        """ Get statistics about the cache of compiled `call` wrappers.
+
+        :rtype:     :class:`CallCacheInfo`
+        """
+        return CallCacheInfo(self.call_cache_hits, self.call_cache_misses,
+                             self._call_cache_size, len(self._call_cache))
+
+    def clear_call_cache(self):
+        """ Discard all cached `call` wrappers and reset the statistics. """
+        self._call_cache.clear()
+        self.call_cache_hits = 0
+        self.call_cache_misses = 0
+
     def eval(self, lua_code):
         return self._rt.eval(lua_code)
 
@@ -84,7 +130,18 @@ class LuaContext(object):
     def globals(self):
         return self._rt.globals()
 
-    def __init__(self):
+    def __init__(self, call_cache_size=128):
+        """ Create a new Lua runtime with all chdkptp modules loaded.
+
+        :param call_cache_size:  Maximum number of compiled wrappers that
+                                 :meth:`call` keeps around, `0` disables
+                                 the cache
+        :type call_cache_size:   int
+        """
+        self._call_cache = OrderedDict()
+        self._call_cache_size = call_cache_size
+        self.call_cache_hits = 0
+        self.call_cache_misses = 0
         self._rt = lupa.LuaRuntime(unpack_returned_tuples=True, encoding=None)
         if self.eval("type(jit) == 'table'"):
             raise RuntimeError("lupa must be linked against Lua, not LuaJIT.\n"
@@ -137,18 +194,133 @@ class LuaContext(object):
         """)
 
 
+_global_lua = None
+_global_lua_lock = threading.Lock()
+
+
+def get_global_lua():
+    """ Get the global Lua runtime, it is created on first use.
+
+    :rtype:     :class:`LuaContext`
+    """
+    global _global_lua
+    with _global_lua_lock:
+        if _global_lua is None:
+            _global_lua = LuaContext()
+    return _global_lua
+
+
+class _LazyLuaContext(object):
+    """ Proxy for the global Lua runtime, so that it is only started (and
+        the USB subsystem initialized) when it is actually used.
+    """
+    def __getattr__(self, name):
+        return getattr(get_global_lua(), name)
+
+
 # Global Lua runtime, for use by utility functions
-global_lua = LuaContext()
+global_lua = _LazyLuaContext()
+
 
-# Lua Table type
-LuaTable = type(global_lua.table())
+def _is_table(value):
+    return lupa.lua_type(value) == 'table'
+
+
+def _read_table(table):
+    """ Read the items of a Lua table and determine if it is a sequence,
+        i.e. if its keys are exactly `1..#table`.
+    """
+    items = dict(table.items())
+    length = len(table)
+    is_sequence = (len(items) == length and
+                   all(idx in items for idx in xrange(1, length+1)))
+    return items, length, is_sequence
+
+
+def parse_table(table, lazy=False):
+    """ Convert a Lua table to Python objects.
+
+    Tables whose keys are exactly `1..#table` (as determined with Lua's
+    length operator) become tuples in the order of their indices, all
+    other tables become dicts. Nested tables are converted without
+    recursion.
+
+    :param table:   Lua table to convert
+    :param lazy:    Don't convert the whole table at once, but return a
+                    read-only view that converts values on access
+    :type lazy:     bool
+    :rtype:         dict/tuple or :class:`LuaTableView`/
+                    :class:`LuaSequenceView` if `lazy` is set
+    """
+    if lazy:
+        return _make_view(table)
+    root = [table]
+    # Sequences are built as lists and turned into tuples once all of their
+    # children are done, i.e. in reverse order of creation.
+    sequences = []
+    stack = [(root, 0, table)]
+    while stack:
+        parent, key, lua_table = stack.pop()
+        items, length, is_sequence = _read_table(lua_table)
+        if is_sequence:
+            out = [items[idx] for idx in xrange(1, length+1)]
+            keys = xrange(length)
+            sequences.append((parent, key, out))
+        else:
+            out = items
+            keys = items.keys()
+        parent[key] = out
+        for child_key in keys:
+            if _is_table(out[child_key]):
+                stack.append((out, child_key, out[child_key]))
+    for parent, key, out in reversed(sequences):
+        parent[key] = tuple(out)
+    return root[0]
+
+
+def _make_view(value):
+    if not _is_table(value):
+        return value
+    items, length, is_sequence = _read_table(value)
+    if is_sequence:
+        return LuaSequenceView(value, length)
+    return LuaTableView(value, items)
+
+
+class LuaTableView(Mapping):
+    """ Read-only mapping view on a Lua table, nested tables are converted
+        on access.
+    """
+    def __init__(self, table, items=None):
+        self._table = table
+        self._items = dict(table.items()) if items is None else items
+
+    def __getitem__(self, key):
+        return _make_view(self._items[key])
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class LuaSequenceView(Sequence):
+    """ Read-only, zero-indexed sequence view on a Lua table, nested tables
+        are converted on access.
+    """
+    def __init__(self, table, length=None):
+        self._table = table
+        self._length = len(table) if length is None else length
 
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return tuple(self[i] for i in xrange(*idx.indices(len(self))))
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError("index out of range")
+        return _make_view(self._table[idx+1])
 
-def parse_table(table):
-    out = dict(table)
-    for key, val in out.iteritems():
-        if isinstance(val, LuaTable):
-            out[key] = parse_table(val)
-    if all(x.isdigit() for x in out.iterkeys()):
-        out = tuple(out.values())
-    return out
+    def __len__(self):
+        return self._length
@@ -0,0 +1,117 @@
+""" Re-using connections and Lua runtimes across device sessions. """
+import logging
+import threading
+
+from chdkptp.device import ChdkDevice, list_devices
+from chdkptp.lua import LuaContext
+
+logger = logging.getLogger('chdkptp.pool')
+
+
+class DevicePool(object):
+    """ Registry of connected devices.
+
+    Devices are kept connected after use and handed out again on subsequent
+    requests, after checking that the connection is still alive. If it is
+    not, the connection is re-established. Lua runtimes of devices that are
+    gone or released are re-used for new devices, so the chdkptp modules do
+    not have to be loaded again; the old device objects can not be used
+    anymore.
+    """
+    def __init__(self, prewarm=0):
+        """ Create a new pool.
+
+        :param prewarm:     Number of Lua runtimes to create in advance
+        :type prewarm:      int
+        """
+        self._devices = {}
+        self._idle_runtimes = [LuaContext() for _ in xrange(prewarm)]
+        self._lock = threading.Lock()
+
+    def get(self, device_info=None, serial_num=None):
+        """ Get a connected device.
+
+        :param device_info: Device to get, if not specified the device with
+                            the given serial number or the first device on
+                            the bus is used
+        :type device_info:  :class:`chdkptp.DeviceInfo`
+        :param serial_num:  Serial number of the device to get
+        :type serial_num:   str
+        :rtype:             :class:`chdkptp.ChdkDevice`
+        """
+        if device_info is None:
+            device_info = self._find_device(serial_num)
+        key = (device_info.bus_num, device_info.device_num)
+        with self._lock:
+            device = self._devices.get(key)
+            if device is not None and not self._check(device):
+                device = self._replace(device)
+            if device is None:
+                device = ChdkDevice(device_info, lua=self._get_runtime())
+            self._devices[key] = device
+            return device
+
+    def _find_device(self, serial_num):
+        devices = list_devices()
+        if serial_num is not None:
+            devices = [info for info in devices
+                       if info.serial_num == serial_num]
+        if not devices:
+            raise ValueError("No matching device found.")
+        return devices[0]
+
+    def _check(self, device):
+        try:
+            return bool(device.is_connected)
+        except Exception:
+            return False
+
+    def _replace(self, device):
+        """ Try to revive the connection of a device, returns `None` if the
+            device is gone.
+        """
+        try:
+            device.reconnect()
+            return device
+        except Exception:
+            logger.warn("Could not reconnect to {0}, re-using its Lua "
+                        "runtime for a new connection"
+                        .format(device.info.model_name))
+        self._idle_runtimes.append(device._detach())
+        return None
+
+    def _get_runtime(self):
+        if self._idle_runtimes:
+            return self._idle_runtimes.pop()
+        return LuaContext()
+
+    def release(self, device):
+        """ Disconnect a device and keep its Lua runtime for other devices.
+            The device can not be used anymore afterwards.
+
+        :param device:  Device to remove from the pool
+        :type device:   :class:`chdkptp.ChdkDevice`
+        """
+        with self._lock:
+            key = (device.info.bus_num, device.info.device_num)
+            if self._devices.get(key) is device:
+                del self._devices[key]
+            try:
+                device.disconnect()
+            except Exception:
+                pass
+            lua = device._detach()
+            if lua is not None:
+                self._idle_runtimes.append(lua)
+
+    def close(self):
+        """ Disconnect all devices in the pool. """
+        for device in list(self._devices.values()):
+            self.release(device)
+        self._idle_runtimes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,235 @@
+""" Host-side processing of raw sensor data captured with CHDK.
+
+CHDK's raw buffer stores the pixels as a bit-packed stream with the bytes
+of every 16 bit word swapped. Swapping them back yields the big-endian bit
+stream that DNG expects, so a DNG file is just the header sent by the
+device, a thumbnail and the swapped raw data.
+"""
+import array
+import struct
+from collections import namedtuple
+
+import chdkptp.util as util
+
+#: Number of bytes and pixels in a packed group, by bits per pixel
+PACKED_GROUPS = {
+    10: (5, 4),
+    12: (3, 2),
+    14: (7, 4),
+}
+
+DngInfo = namedtuple("DngInfo", ('width', 'height', 'bpp', 'cfa_pattern',
+                                 'black_level', 'white_level', 'thumb_width',
+                                 'thumb_height', 'thumb_offset', 'raw_offset'))
+
+# TIFF tags that are read from the header
+_TAGS = {
+    256: 'width',
+    257: 'height',
+    258: 'bpp',
+    273: 'offset',
+    330: 'sub_ifds',
+    33422: 'cfa_pattern',
+    50714: 'black_level',
+    50717: 'white_level',
+}
+# Formats of TIFF field types, by type number
+_TYPES = {
+    1: 'B',
+    3: 'H',
+    4: 'I',
+    7: 'B',
+    8: 'h',
+    9: 'i',
+}
+
+
+def _read_ifd(header, offset):
+    count, = struct.unpack_from('<H', header, offset)
+    fields = {}
+    for idx in xrange(count):
+        tag, type_, length, value = struct.unpack_from(
+            '<HHI4s', header, offset + 2 + idx*12)
+        if tag not in _TAGS or type_ not in _TYPES:
+            continue
+        fmt = '<{0}{1}'.format(length, _TYPES[type_])
+        if struct.calcsize(fmt) <= 4:
+            values = struct.unpack_from(fmt, value)
+        else:
+            values = struct.unpack_from(
+                fmt, header, struct.unpack('<I', value)[0])
+        fields[_TAGS[tag]] = values
+    return fields
+
+
+def parse_dng_header(header):
+    """ Read the image layout from a DNG header sent by the device.
+
+    :param header:  DNG header as captured with the `dng_hdr` format
+    :type header:   str
+    :rtype:         :class:`DngInfo`
+    """
+    if header[:4] != b'II*\x00':
+        raise ValueError("Not a little-endian TIFF header")
+    thumb = _read_ifd(header, struct.unpack_from('<I', header, 4)[0])
+    if 'sub_ifds' not in thumb:
+        raise ValueError("DNG header has no raw image")
+    raw = _read_ifd(header, thumb['sub_ifds'][0])
+    bpp = raw['bpp'][0]
+    return DngInfo(
+        width=raw['width'][0], height=raw['height'][0], bpp=bpp,
+        cfa_pattern=raw.get('cfa_pattern', (0, 1, 1, 2)),
+        black_level=raw.get('black_level', (0,))[0],
+        white_level=raw.get('white_level', ((1 << bpp) - 1,))[0],
+        thumb_width=thumb['width'][0], thumb_height=thumb['height'][0],
+        thumb_offset=thumb['offset'][0], raw_offset=raw['offset'][0])
+
+
+def swap_raw(data):
+    """ Swap the bytes in every 16 bit word of CHDK raw data, which results
+        in a big-endian bit stream.
+
+    :param data:    Raw data from the device
+    :type data:     str/buffer
+    :rtype:         :class:`numpy.ndarray` of bytes
+    """
+    numpy = util.import_numpy()
+    return numpy.frombuffer(data, dtype='<u2').byteswap().view(numpy.uint8)
+
+
+def unpack_raw(data, width, height, bpp):
+    """ Unpack raw sensor data from the device into an array of pixel values.
+
+    :param data:    Raw data from the device
+    :type data:     str/buffer
+    :param width:   Width of the sensor data in pixels
+    :type width:    int
+    :param height:  Height of the sensor data in pixels
+    :type height:   int
+    :param bpp:     Bits per pixel, one of 10, 12 or 14
+    :type bpp:      int
+    :rtype:         :class:`numpy.ndarray` of `uint16` with shape
+                    `(height, width)`
+    """
+    return _unpack_swapped(swap_raw(data), width, height, bpp)
+
+
+def _unpack_swapped(data, width, height, bpp):
+    numpy = util.import_numpy()
+    if bpp not in PACKED_GROUPS:
+        raise ValueError("Unsupported bits per pixel: {0}".format(bpp))
+    group_bytes, group_pixels = PACKED_GROUPS[bpp]
+    size = width*height*bpp//8
+    if len(data) < size:
+        raise ValueError("Raw data is too short for {0}x{1} pixels at {2} "
+                         "bits".format(width, height, bpp))
+    b = data[:size].reshape(-1, group_bytes).astype(numpy.uint16)
+    pixels = numpy.empty((b.shape[0], group_pixels), dtype=numpy.uint16)
+    if bpp == 10:
+        pixels[:, 0] = (b[:, 0] << 2) | (b[:, 1] >> 6)
+        pixels[:, 1] = ((b[:, 1] & 0x3f) << 4) | (b[:, 2] >> 4)
+        pixels[:, 2] = ((b[:, 2] & 0x0f) << 6) | (b[:, 3] >> 2)
+        pixels[:, 3] = ((b[:, 3] & 0x03) << 8) | b[:, 4]
+    elif bpp == 12:
+        pixels[:, 0] = (b[:, 0] << 4) | (b[:, 1] >> 4)
+        pixels[:, 1] = ((b[:, 1] & 0x0f) << 8) | b[:, 2]
+    else:
+        pixels[:, 0] = (b[:, 0] << 6) | (b[:, 1] >> 2)
+        pixels[:, 1] = (((b[:, 1] & 0x03) << 12) | (b[:, 2] << 4) |
+                        (b[:, 3] >> 4))
+        pixels[:, 2] = (((b[:, 3] & 0x0f) << 10) | (b[:, 4] << 2) |
+                        (b[:, 5] >> 6))
+        pixels[:, 3] = ((b[:, 5] & 0x3f) << 8) | b[:, 6]
+    return pixels.reshape(height, width)
+
+
+def make_thumbnail(data, info):
+    """ Render a small RGB preview from the raw data sent by the device.
+
+    Every thumbnail pixel is taken from one 2x2 block of the color filter
+    array, values are scaled between black and white level with a gamma of
+    2.2. Only the sampled rows are unpacked.
+
+    :param data:    Raw data from the device
+    :type data:     str/buffer
+    :param info:    Layout of the image
+    :type info:     :class:`DngInfo`
+    :return:        8 bit RGB data
+    :rtype:         :class:`numpy.ndarray` with shape
+                    `(thumb_height, thumb_width, 3)`
+    """
+    numpy = util.import_numpy()
+    stride = info.width*info.bpp//8
+    rows = _thumbnail_rows(info)
+    if stride % 2:
+        # Rows do not start on a 16 bit word, they can only be taken from
+        # the swapped data
+        return _thumbnail_from_swapped(swap_raw(data), info)
+    words = numpy.frombuffer(data, dtype='<u2', count=info.height*stride//2)
+    row_data = words.reshape(info.height, stride//2)[rows]
+    return _render_thumbnail(row_data.byteswap().view(numpy.uint8), info)
+
+
+def _thumbnail_rows(info):
+    """ Get the indices of the row pairs that are sampled for the thumbnail.
+    """
+    numpy = util.import_numpy()
+    rows = numpy.linspace(0, info.height//2 - 1,
+                          info.thumb_height).astype(numpy.intp)*2
+    return numpy.column_stack((rows, rows + 1)).ravel()
+
+
+def _thumbnail_from_swapped(swapped, info):
+    stride = info.width*info.bpp//8
+    row_data = swapped[:info.height*stride].reshape(info.height, stride)
+    return _render_thumbnail(row_data[_thumbnail_rows(info)], info)
+
+
+def _render_thumbnail(row_data, info):
+    """ Render the thumbnail from the swapped data of the sampled row pairs.
+    """
+    numpy = util.import_numpy()
+    pixels = _unpack_swapped(row_data.ravel(), info.width, row_data.shape[0],
+                             info.bpp)
+    cols = numpy.linspace(0, info.width//2 - 1,
+                          info.thumb_width).astype(numpy.intp)*2
+    rgb = numpy.zeros((info.thumb_height, info.thumb_width, 3))
+    counts = numpy.zeros(3)
+    for idx, color in enumerate(info.cfa_pattern[:4]):
+        rgb[:, :, color] += pixels[idx//2::2, cols + idx % 2]
+        counts[color] += 1
+    rgb /= numpy.maximum(counts, 1)
+    rgb = (rgb - info.black_level)/float(info.white_level - info.black_level)
+    rgb = numpy.clip(rgb, 0, 1)**(1/2.2)*255
+    return rgb.astype(numpy.uint8)
+
+
+def write_dng(write, header, data):
+    """ Write a DNG file from the header and raw data sent by the device.
+
+    The thumbnail is rendered from the raw data with :func:`make_thumbnail`
+    if NumPy is installed, otherwise it is left black.
+
+    :param write:   Function that is called with every part of the file and
+                    its offset
+    :type write:    callable
+    :param header:  DNG header as captured with the `dng_hdr` format
+    :type header:   str
+    :param data:    Raw data from the device
+    :type data:     str/buffer
+    """
+    info = parse_dng_header(header)
+    write(header, 0)
+    try:
+        util.import_numpy()
+    except RuntimeError:
+        # Without NumPy, the raw data is only swapped and the thumbnail is
+        # left black
+        swapped = array.array('H', data)
+        swapped.byteswap()
+        write(b'\x00'*(info.thumb_width*info.thumb_height*3),
+              info.thumb_offset)
+        write(swapped.tostring(), info.raw_offset)
+        return
+    write(make_thumbnail(data, info).data, info.thumb_offset)
+    write(swap_raw(data).data, info.raw_offset)
@@ -0,0 +1,99 @@
+""" Prepared scripts for repeated execution on the device. """
+import time
+from collections import namedtuple
+
+from chdkptp.serialize import serialize
+
+ScriptStats = namedtuple("ScriptStats", ('calls', 'total_time', 'mean_time',
+                                         'min_time', 'max_time'))
+
+
+class PreparedScript(object):
+    """ Lua code that can be run on the device repeatedly with different
+        parameters.
+
+    The host-side code for running the script and the table of remote
+    libraries are only created once. Parameters are passed to the script as
+    local variables whose values are serialized safely, so they can contain
+    arbitrary strings.
+    """
+    def __init__(self, device, lua_code, remote_libs=(), params=(),
+                 do_return=True):
+        """ Prepare a script, usually created with
+            :meth:`chdkptp.ChdkDevice.prepare`.
+
+        :param device:      Device to run the script on
+        :type device:       :class:`chdkptp.ChdkDevice`
+        :param lua_code:    Lua code to execute
+        :type lua_code:     str/unicode
+        :param remote_libs: Names of modules from `rlibs.lua` that should be
+                            uploaded along with the code
+        :type remote_libs:  List of str/unicode
+        :param params:      Names of the parameters of the script
+        :type params:       List of str
+        :param do_return:   Return value of lua code
+        :type do_return:    bool
+        """
+        self.device = device
+        self.lua_code = lua_code
+        self.params = tuple(params)
+        self.do_return = do_return
+        self._libs = device._lua.table(*remote_libs)
+        self._calls = 0
+        self._total_time = 0.0
+        self._min_time = None
+        self._max_time = None
+
+    @property
+    def stats(self):
+        """ Timing statistics for all runs of the script, in seconds.
+
+        :rtype:     :class:`ScriptStats`
+        """
+        return ScriptStats(self._calls, self._total_time,
+                           self._total_time/(self._calls or 1),
+                           self._min_time, self._max_time)
+
+    def _build_code(self, args, kwargs):
+        if len(args) > len(self.params):
+            raise TypeError("Script takes {0} parameters, {1} given"
+                            .format(len(self.params), len(args)))
+        values = dict(zip(self.params, args))
+        for name, value in kwargs.iteritems():
+            if name not in self.params:
+                raise TypeError("Unknown parameter '{0}'".format(name))
+            if name in values:
+                raise TypeError("Got multiple values for parameter '{0}'"
+                                .format(name))
+            values[name] = value
+        if not self.params:
+            return self.lua_code
+        return "local {0} = {1}\n{2}".format(
+            ", ".join(self.params),
+            ", ".join(serialize(values.get(name)) for name in self.params),
+            self.lua_code)
+
+    def __call__(self, *args, **kwargs):
+        """ Run the script and wait for it to finish.
+
+        Positional and keyword arguments are assigned to the parameters of
+        the script, missing parameters are `nil`.
+
+        :return:    Return value(s) of the script if `do_return` was set
+        """
+        code = self._build_code(args, kwargs)
+        start = time.time()
+        try:
+            rvals = self.device._execute(code, self._libs)
+        finally:
+            duration = time.time() - start
+            self._calls += 1
+            self._total_time += duration
+            if self._min_time is None or duration < self._min_time:
+                self._min_time = duration
+            if self._max_time is None or duration > self._max_time:
+                self._max_time = duration
+        if self.do_return:
+            return self.device._parse_return_values(rvals)
+
+    run = __call__
@@ -0,0 +1,213 @@
+""" Conversion between Python values and Lua literals.
+
+Messages with tables that are sent by scripts on the device are serialized
+to Lua source code by chdkptp's `serialize`. Instead of evaluating that
+code, which would require a compile step for every message and allow the
+device to run arbitrary code on the host, it is parsed by
+:func:`unserialize`. Only literals are supported: `nil`, booleans, numbers,
+strings and (nested) tables. :func:`serialize` does the opposite and is
+used to safely pass values to scripts on the device.
+"""
+import re
+
+# Every match has one group for each kind of token, the remaining groups
+# are empty: punctuation, number, name, quoted string, opening of a long
+# string and its level and content, and invalid input
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        ([{}\]=,;]|\[(?![\[=]))
+      | (-?\s*(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?))
+      | ([A-Za-z_][A-Za-z0-9_]*)
+      | ("[^"\\\n]*(?:\\.[^"\\\n]*)*"|'[^'\\\n]*(?:\\.[^'\\\n]*)*')
+      | (\[(=*)\[)(.*?)\]\6\]
+      | (\S)
+    )""", re.VERBOSE | re.DOTALL)
+ESCAPE_RE = re.compile(r"""\\(?:(?P<digits>\d{1,3})
+                               |x(?P<hex>[0-9a-fA-F]{2})
+                               |z\s*
+                               |(?P<char>.))""", re.VERBOSE | re.DOTALL)
+ESCAPES = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+           'v': '\v', '\\': '\\', '"': '"', "'": "'", '\n': '\n'}
+CONSTANTS = {'true': True, 'false': False, 'nil': None}
+
+NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+LUA_KEYWORDS = frozenset((
+    'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for',
+    'function', 'goto', 'if', 'in', 'local', 'nil', 'not', 'or', 'repeat',
+    'return', 'then', 'true', 'until', 'while'))
+# Everything that is not printable ASCII, as well as quotes and backslashes
+SERIALIZE_ESCAPE_RE = re.compile(r'[^ !#-\[\]-~]')
+
+
+class UnserializeError(ValueError):
+    pass
+
+
+def _unescape_match(match):
+    if match.group('digits') is not None:
+        return chr(int(match.group('digits')))
+    elif match.group('hex') is not None:
+        return chr(int(match.group('hex'), 16))
+    elif match.group('char') is not None:
+        try:
+            return ESCAPES[match.group('char')]
+        except KeyError:
+            raise UnserializeError("Invalid escape sequence '\\{0}'"
+                                   .format(match.group('char')))
+    # \z skips all following whitespace
+    return ''
+
+
+def _parse_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    text = text.replace(' ', '').replace('\t', '')
+    negative = text.startswith('-')
+    text = text.lstrip('-')
+    if text[:2] in ('0x', '0X'):
+        value = int(text, 16)
+    else:
+        value = float(text)
+    return -value if negative else value
+
+
+def _parse_string(token):
+    if token[4]:
+        value = token[6]
+        # A newline directly after the opening bracket is skipped
+        if value.startswith('\r\n'):
+            return value[2:]
+        elif value.startswith('\n'):
+            return value[1:]
+        return value
+    value = token[3][1:-1]
+    if '\\' in value:
+        value = ESCAPE_RE.sub(_unescape_match, value)
+    return value
+
+
+def _parse_value(tokens, pos):
+    token = tokens[pos]
+    if token[1]:
+        return _parse_number(token[1]), pos+1
+    elif token[3] or token[4]:
+        return _parse_string(token), pos+1
+    elif token[0] == '{':
+        return _parse_table(tokens, pos+1)
+    elif token[2] in CONSTANTS:
+        return CONSTANTS[token[2]], pos+1
+    raise UnserializeError("Unexpected token '{0}'".format(
+        token[0] or token[2] or token[7]))
+
+
+def _parse_table(tokens, pos):
+    items = {}
+    idx = 1
+    while True:
+        token = tokens[pos]
+        if token[0] == '}':
+            return _finish_table(items), pos+1
+        elif token[0] == '[':
+            key, pos = _parse_value(tokens, pos+1)
+            if key is None:
+                raise UnserializeError("Table index is nil")
+            elif isinstance(key, (dict, tuple)):
+                raise UnserializeError("Tables are not supported as keys")
+            if tokens[pos][0] != ']' or tokens[pos+1][0] != '=':
+                raise UnserializeError("Expected ']='")
+            value, pos = _parse_value(tokens, pos+2)
+        elif (token[2] and token[2] not in CONSTANTS and
+                tokens[pos+1][0] == '='):
+            key = token[2]
+            value, pos = _parse_value(tokens, pos+2)
+        else:
+            key = idx
+            idx += 1
+            value, pos = _parse_value(tokens, pos)
+        if value is not None:
+            items[key] = value
+        sep = tokens[pos][0]
+        if sep == ',' or sep == ';':
+            pos += 1
+        elif sep != '}':
+            raise UnserializeError("Expected ',' or '}'")
+
+
+def _finish_table(items):
+    length = len(items)
+    if all(idx in items for idx in xrange(1, length+1)):
+        return tuple(items[idx] for idx in xrange(1, length+1))
+    return items
+
+
+def unserialize(text):
+    """ Parse a serialized Lua value.
+
+    Tables are converted like in :func:`chdkptp.lua.parse_table`, i.e.
+    tables whose keys are exactly `1..n` become tuples, all others dicts.
+
+    :param text:    Serialized value
+    :type text:     str
+    :raises:        :class:`UnserializeError` if `text` is not a valid
+                    literal
+    """
+    tokens = TOKEN_RE.findall(text)
+    try:
+        value, pos = _parse_value(tokens, 0)
+    except IndexError:
+        raise UnserializeError("Incomplete value")
+    if pos != len(tokens):
+        raise UnserializeError("Trailing data after value")
+    return value
+
+
+def _serialize_string(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"{0}"'.format(SERIALIZE_ESCAPE_RE.sub(
+        lambda m: '\\{0:03d}'.format(ord(m.group())), value))
+
+
+def serialize(value):
+    """ Serialize a Python value to a Lua literal.
+
+    This is the inverse of :func:`unserialize`, sequences become Lua
+    sequences and mappings become tables with the same keys. Strings are
+    always quoted safely, so the result can be embedded into Lua code.
+
+    :param value:   Value to serialize
+    :type value:    None/bool/int/float/str/unicode/list/tuple/dict
+    :rtype:         str
+    """
+    if value is None:
+        return 'nil'
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError("Cannot serialize {0!r}".format(value))
+        return repr(value)
+    elif isinstance(value, basestring):
+        return _serialize_string(value)
+    elif isinstance(value, (list, tuple)):
+        return '{' + ','.join(serialize(item) for item in value) + '}'
+    elif isinstance(value, dict):
+        fields = []
+        for key, item in value.iteritems():
+            if (isinstance(key, basestring) and NAME_RE.match(key) and
+                    key not in LUA_KEYWORDS):
+                fields.append('{0}={1}'.format(key, serialize(item)))
+            elif key is None or isinstance(key, (list, tuple, dict)):
+                raise ValueError("Cannot serialize key {0!r}".format(key))
+            else:
+                fields.append('[{0}]={1}'.format(serialize(key),
+                                                 serialize(item)))
+        return '{' + ','.join(fields) + '}'
+    raise ValueError("Cannot serialize value of type {0}"
+                     .format(type(value).__name__))
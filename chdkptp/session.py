@@ -0,0 +1,108 @@
+""" Shooting sessions with a resident script on the device. """
+import time
+
+#: Script that stays resident on the device, it reads serialized shooting
+#: options from the message queue, shoots and sends back the result.
+SESSION_SCRIPT = """
+while true do
+    local msg = read_usb_msg(50)
+    if msg == 'quit' then
+        return
+    elseif msg then
+        local opts, err = unserialize(msg)
+        if opts then
+            write_usb_msg(rlib_shoot(opts))
+        else
+            write_usb_msg({error=err})
+        end
+    end
+end
+"""
+SESSION_LIBS = ['serialize_msgs', 'unserialize', 'rlib_shoot']
+
+
+class ShootingSession(object):
+    """ Keeps a shooting script running on the device and triggers shots
+        through messages.
+
+        The remote libraries are only uploaded and compiled once when the
+        session is started, every subsequent shot only costs a message
+        round-trip. Use as a context manager or call :meth:`start` and
+        :meth:`stop` explicitly. The device must be in record mode.
+    """
+    def __init__(self, device, timeout=30):
+        """ Create a new session.
+
+        :param device:      Device to shoot with
+        :type device:       :class:`chdkptp.ChdkDevice`
+        :param timeout:     Maximum time in seconds to wait for a shot
+        :type timeout:      int/float
+        """
+        self.device = device
+        self.timeout = timeout
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.device.lua_execute(SESSION_SCRIPT, wait=False,
+                                remote_libs=SESSION_LIBS)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.device.send_message('quit')
+        self.device.wait_for_script()
+
+    def shoot(self, **kwargs):
+        """ Shoot a picture with the resident script.
+
+        :param kwargs:  Capture settings, see
+                        :meth:`chdkptp.ChdkDevice.shoot`. Only non-streaming
+                        capture is supported, i.e. `stream` and `wait`
+                        must not be passed.
+        :return:        If `download_after` was specified the image data,
+                        otherwise `None`
+        """
+        if not self.running:
+            raise RuntimeError("Session is not running.")
+        for arg in ('stream', 'wait', 'output', 'raw_array'):
+            if arg in kwargs:
+                raise ValueError("`{0}` is not supported in a session"
+                                 .format(arg))
+        kwargs['stream'] = False
+        download = kwargs.pop('download_after', False)
+        remove = kwargs.pop('remove_after', False)
+        self.device._validate_shoot_args(download_after=download,
+                                         remove_after=remove, **kwargs)
+        options = self.device._serialize_shoot_args(**kwargs)
+        self.device.send_message(options)
+        status = self._wait_for_result()
+        return self.device._fetch_capture(status, download=download,
+                                          remove=remove)
+
+    def _wait_for_result(self):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            for msg in self.device.get_messages():
+                if msg.type == 'user':
+                    if isinstance(msg.value, dict) and 'error' in msg.value:
+                        raise RuntimeError("Could not parse shooting options:"
+                                           " {0}".format(msg.value['error']))
+                    return msg.value
+                self.running = False
+                if msg.type == 'error':
+                    raise RuntimeError("Session script failed: {0}"
+                                       .format(msg.value))
+                raise RuntimeError("Session script terminated.")
+            time.sleep(0.01)
+        raise RuntimeError("Timed out waiting for shot.")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
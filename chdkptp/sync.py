@@ -0,0 +1,204 @@
+""" Incremental synchronization of files from the device to the host. """
+import os
+import posixpath
+import sqlite3
+import time
+from collections import namedtuple
+
+import chdkptp.util as util
+
+#: Default name of the index database, stored in the local directory
+INDEX_FILENAME = '.chdkptp-sync.db'
+
+SyncResult = namedtuple("SyncResult", ('transferred', 'skipped', 'deleted',
+                                       'transferred_bytes', 'duration'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    serial_num  TEXT NOT NULL,
+    remote_path TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime       INTEGER NOT NULL,
+    local_path  TEXT NOT NULL,
+    synced_at   REAL NOT NULL,
+    deleted     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (serial_num, remote_path)
+)
+"""
+
+
+class SyncIndex(object):
+    """ Persistent index of the files that were transferred from devices.
+
+    Every file is stored with its size and modification time on the device,
+    keyed by the serial number of the device and the remote path. Entries
+    are committed as soon as a file has been transferred, so an interrupted
+    synchronization resumes with the first file that is missing.
+    """
+    def __init__(self, path):
+        """ Open or create an index.
+
+        :param path:    Path to the SQLite database
+        :type path:     str/unicode
+        """
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def get(self, serial_num, remote_path):
+        """ Get the indexed size, modification time and local path of a file.
+
+        :return:    `(size, mtime, local_path, deleted)` or `None` if the file
+                    was never transferred
+        :rtype:     tuple
+        """
+        return self._db.execute(
+            "SELECT size, mtime, local_path, deleted FROM files "
+            "WHERE serial_num = ? AND remote_path = ?",
+            (serial_num, remote_path)).fetchone()
+
+    def add(self, serial_num, remote_path, size, mtime, local_path):
+        """ Record a transferred file. """
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (serial_num, remote_path, size, "
+                "mtime, local_path, synced_at, deleted) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (serial_num, remote_path, size, mtime, local_path,
+                 time.time()))
+
+    def mark_deleted(self, serial_num, remote_paths):
+        """ Record that files were deleted from the device. """
+        with self._db:
+            self._db.executemany(
+                "UPDATE files SET deleted = 1 "
+                "WHERE serial_num = ? AND remote_path = ?",
+                ((serial_num, path) for path in remote_paths))
+
+    def pending_deletes(self, serial_num):
+        """ Get all files that were transferred, but not yet deleted from the
+            device.
+        """
+        return [row[0] for row in self._db.execute(
+            "SELECT remote_path FROM files "
+            "WHERE serial_num = ? AND deleted = 0", (serial_num,))]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _is_current(entry, size, mtime):
+    if entry is None or entry[3] or tuple(entry[:2]) != (size, mtime):
+        return False
+    local_path = entry[2]
+    return (os.path.exists(local_path) and
+            os.path.getsize(local_path) == size)
+
+
+def _get_local_path(entry, default_path, size, mtime):
+    """ Get the local path for a file that is to be transferred.
+
+    An existing local file is only replaced if it is an incomplete copy of
+    the same file, i.e. the index entry is not deleted and has the same size
+    and modification time. Files from before a deletion on the device, older
+    versions of a file and files that are not in the index are kept and the
+    new file is stored under a name with its modification time appended.
+    """
+    if (entry is not None and not entry[3] and
+            tuple(entry[:2]) == (size, mtime)):
+        return entry[2]
+    if not os.path.exists(default_path):
+        return default_path
+    base, ext = os.path.splitext(default_path)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(mtime))
+    local_path = "{0}_{1}{2}".format(base, stamp, ext)
+    num = 1
+    while os.path.exists(local_path):
+        local_path = "{0}_{1}_{2}{3}".format(base, stamp, num, ext)
+        num += 1
+    return local_path
+
+
+def sync(device, remote_dir, local_dir, delete=False, index_path=None):
+    """ Transfer all new or changed files below a directory on the device.
+
+    Files are compared by size and modification time against the index of
+    previously transferred files for the device's serial number, unchanged
+    files are not transferred again. Every file is first downloaded to a
+    temporary name and only renamed and added to the index once its size has
+    been verified. Existing local files are never replaced by a different
+    file, e.g. when the device reuses the name of a deleted file, the new
+    file is stored with its modification time appended to the name.
+
+    :param device:      Device to synchronize from
+    :type device:       :class:`chdkptp.ChdkDevice`
+    :param remote_dir:  Directory on the device
+    :type remote_dir:   str/unicode
+    :param local_dir:   Local target directory, the directory structure below
+                        `remote_dir` is preserved
+    :type local_dir:    str/unicode
+    :param delete:      Delete files from the device once they have been
+                        transferred and verified
+    :type delete:       bool
+    :param index_path:  Path to the index database, defaults to
+                        `.chdkptp-sync.db` in `local_dir`
+    :type index_path:   str/unicode
+    :rtype:             :class:`SyncResult`
+    """
+    start = time.time()
+    remote_dir = util.to_camerapath(remote_dir).rstrip('/')
+    local_dir = os.path.abspath(local_dir)
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    serial_num = device.info.serial_num
+    transferred, skipped = [], []
+    transferred_bytes = 0
+    with SyncIndex(index_path or os.path.join(local_dir,
+                                              INDEX_FILENAME)) as index:
+        # The listing script must have finished before downloading
+        for remote_path, size, mtime in list(device.walk_files(remote_dir)):
+            entry = index.get(serial_num, remote_path)
+            if _is_current(entry, size, mtime):
+                skipped.append(remote_path)
+                continue
+            local_path = _get_local_path(
+                entry,
+                os.path.join(local_dir, *posixpath.relpath(
+                    remote_path, remote_dir).split('/')),
+                size, mtime)
+            if not os.path.isdir(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            tmp_path = local_path + '.part'
+            device.download_file(remote_path, tmp_path)
+            if os.path.getsize(tmp_path) != size:
+                os.unlink(tmp_path)
+                raise IOError("Size of downloaded file {0} does not match "
+                              "size on device".format(remote_path))
+            if os.path.exists(local_path):
+                # os.rename does not replace existing files on Windows
+                os.unlink(local_path)
+            os.rename(tmp_path, local_path)
+            os.utime(local_path, (mtime, mtime))
+            index.add(serial_num, remote_path, size, mtime, local_path)
+            transferred.append(remote_path)
+            transferred_bytes += size
+        deleted = []
+        if delete:
+            # Includes files that were transferred in earlier, interrupted
+            # runs, files that are no longer on the device are skipped
+            listed = set(transferred + skipped)
+            pending = [path for path in index.pending_deletes(serial_num)
+                       if path.startswith(remote_dir + '/')]
+            deleted = [path for path in pending if path in listed]
+            if deleted:
+                device.delete_files(*deleted)
+            index.mark_deleted(serial_num, pending)
+    return SyncResult(transferred, skipped, deleted, transferred_bytes,
+                      time.time() - start)
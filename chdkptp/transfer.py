@@ -0,0 +1,305 @@
+""" Bulk file transfers between the device and the host. """
+import hashlib
+import json
+import os
+import posixpath
+import time
+from collections import namedtuple
+
+import chdkptp.util as util
+from chdkptp.serialize import serialize
+
+#: Number of files to check in a single call to the device
+STAT_BATCH_SIZE = 64
+#: Maximum difference between local and remote modification times, FAT
+#: only stores them with a two second resolution
+MTIME_TOLERANCE = 2
+
+RemoteFile = namedtuple("RemoteFile", ('path', 'size', 'mtime'))
+DownloadResult = namedtuple("DownloadResult", ('remote_path', 'local_path',
+                                               'size', 'duration', 'error'))
+DownloadStats = namedtuple("DownloadStats", ('files', 'transferred_bytes',
+                                             'duration', 'throughput',
+                                             'errors', 'results'))
+UploadStats = namedtuple("UploadStats", ('uploaded', 'skipped',
+                                         'uploaded_bytes', 'saved_bytes',
+                                         'duration'))
+
+_ORDER_KEYS = {
+    'name': (lambda f: f.path, False),
+    'newest': (lambda f: f.mtime, True),
+    'oldest': (lambda f: f.mtime, False),
+    'largest': (lambda f: f.size, True),
+    'smallest': (lambda f: f.size, False),
+}
+
+
+def stat_remote(device, remote_paths, batch_size=STAT_BATCH_SIZE):
+    """ Get the `os.stat` information for many paths on the device, with one
+        call to the device per `batch_size` paths.
+
+    :return:    Stat information for every path, `None` for paths that do not
+                exist
+    :rtype:     list of dicts
+    """
+    stats = []
+    for idx in xrange(0, len(remote_paths), batch_size):
+        stats.extend(
+            stat if isinstance(stat, dict) else None
+            for stat in device.evaluate(
+                *("os.stat({0})".format(serialize(path))
+                  for path in remote_paths[idx:idx+batch_size])))
+    return stats
+
+
+def expand_remote_paths(device, remote_paths):
+    """ Get all files for a list of remote files and directories.
+
+    All paths are checked with :func:`stat_remote`, directories are listed
+    with :meth:`chdkptp.ChdkDevice.walk_files`.
+
+    :return:    `(base directory, file)` pairs, where the base directory is
+                the directory that local paths are relative to
+    :rtype:     list of tuples
+    """
+    remote_paths = [util.to_camerapath(p).rstrip('/') for p in remote_paths]
+    files = []
+    for path, stat in zip(remote_paths, stat_remote(device, remote_paths)):
+        if stat is None:
+            raise IOError("Could not find {0} on device".format(path))
+        base = posixpath.dirname(path)
+        if stat.get('is_dir'):
+            files.extend((base, remote_file)
+                         for remote_file in device.walk_files(path))
+        else:
+            files.append((base, RemoteFile(path, stat['size'],
+                                           stat['mtime'])))
+    return files
+
+
+def _get_downloader(lua):
+    # Runs as a coroutine that yields after every file, so results can be
+    # reported as soon as a file is on disk and the download can be stopped
+    # between any two files
+    return lua.eval("""
+        function(remote_paths, local_paths)
+            for i, remote_path in ipairs(remote_paths) do
+                local ok, err = pcall(con.download, con, remote_path,
+                                      local_paths[i])
+                coroutine.yield(i, ok, (not ok) and tostring(err) or nil)
+            end
+        end
+    """)
+
+
+def iter_download(device, remote_paths, local_path='./', overwrite=False,
+                  order=None):
+    """ Download files and directories from the device, one result per file.
+
+    All files are downloaded by a single Lua coroutine that yields after
+    every file, the result of a file is yielded as soon as it has been
+    written. Stop iterating to stop the download, no further files are
+    transferred.
+
+    :param device:          Device to download from
+    :type device:           :class:`chdkptp.ChdkDevice`
+    :param remote_paths:    Files and directories on the device
+    :type remote_paths:     collection of str/unicode
+    :param local_path:      Target directory on the local file system
+    :type local_path:       str/unicode
+    :param overwrite:       Overwrite existing files, otherwise they are
+                            skipped
+    :type overwrite:        bool
+    :param order:           Order in which to download the files, one of
+                            'name', 'newest', 'oldest', 'largest',
+                            'smallest', or a key function that is called with
+                            :class:`RemoteFile` tuples
+    :type order:            str/callable
+    :rtype:                 generator, yields :class:`DownloadResult`
+    """
+    local_path = os.path.abspath(local_path)
+    files = expand_remote_paths(device, remote_paths)
+    if order is not None:
+        if callable(order):
+            key, reverse = order, False
+        elif order in _ORDER_KEYS:
+            key, reverse = _ORDER_KEYS[order]
+        else:
+            raise ValueError("Unknown order '{0}'".format(order))
+        files.sort(key=lambda item: key(item[1]), reverse=reverse)
+    targets = []
+    for base, remote_file in files:
+        target = os.path.join(
+            local_path,
+            *posixpath.relpath(remote_file.path, base).split('/'))
+        if overwrite or not os.path.exists(target):
+            targets.append((remote_file, target))
+    if not targets:
+        return
+    for _, target in targets:
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+    download = _get_downloader(device._lua).coroutine(
+        device._lua.table(*(f.path for f, _ in targets)),
+        device._lua.table(*(t for _, t in targets)))
+    last = time.time()
+    for idx, ok, error in download:
+        remote_file, target = targets[idx-1]
+        now = time.time()
+        if ok:
+            os.utime(target, (remote_file.mtime, remote_file.mtime))
+        elif os.path.exists(target):
+            os.unlink(target)
+        yield DownloadResult(remote_file.path, target,
+                             remote_file.size if ok else 0, now - last, error)
+        last = now
+
+
+def batch_download(device, remote_paths, local_path='./', overwrite=False,
+                   order=None, progress=None):
+    """ Download files and directories from the device and collect
+        statistics, see :func:`iter_download` for the parameters.
+
+    :param progress:    Function that is called with the
+                        :class:`DownloadResult` of every file as soon as it
+                        has been downloaded, if it returns `False` the
+                        download is stopped
+    :type progress:     callable
+    :rtype:             :class:`DownloadStats`
+    """
+    start = time.time()
+    results = []
+    for result in iter_download(device, remote_paths, local_path, overwrite,
+                                order):
+        results.append(result)
+        if progress is not None and progress(result) is False:
+            break
+    duration = time.time() - start
+    transferred_bytes = sum(r.size for r in results)
+    return DownloadStats(
+        files=len(results), transferred_bytes=transferred_bytes,
+        duration=duration,
+        throughput=transferred_bytes/duration if duration else None,
+        errors=[r for r in results if r.error is not None],
+        results=results)
+
+
+def _local_files(local_paths):
+    """ Get `(local path, relative remote path)` for all files, directories
+        are uploaded with their name, like :command:`cp -r` does.
+    """
+    for local_path in local_paths:
+        local_path = os.path.abspath(local_path)
+        base = os.path.dirname(local_path)
+        if not os.path.isdir(local_path):
+            yield local_path, os.path.basename(local_path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(local_path):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                path = os.path.join(dirpath, fname)
+                yield path, os.path.relpath(path, base).replace(os.sep, '/')
+
+
+def _checksum(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(64*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_unchanged(local_path, local_stat, remote_stat, record):
+    if remote_stat is None or remote_stat['size'] != local_stat.st_size:
+        return False
+    if abs(remote_stat['mtime'] - local_stat.st_mtime) <= MTIME_TOLERANCE:
+        return True
+    # The local file was touched, but it may still have the content that
+    # was uploaded last time, if the remote file was not changed since
+    return (record is not None and record[0] == remote_stat['size'] and
+            abs(record[1] - remote_stat['mtime']) <= MTIME_TOLERANCE and
+            record[2] == _checksum(local_path))
+
+
+def batch_upload(device, local_paths, remote_path='A/', skip_unchanged=True,
+                 manifest=None):
+    """ Upload files and directories to the device, skipping files that
+        are already on the device.
+
+    A file is considered unchanged if the file on the device has the same
+    size and modification time. The remote files are checked with
+    :func:`stat_remote`, so only one call to the device is needed for every
+    :data:`STAT_BATCH_SIZE` files. Uploaded files get the modification time
+    of the local file.
+
+    :param device:          Device to upload to
+    :type device:           :class:`chdkptp.ChdkDevice`
+    :param local_paths:     Local files and directories
+    :type local_paths:      collection of str/unicode
+    :param remote_path:     Target directory on the device
+    :type remote_path:      str/unicode
+    :param skip_unchanged:  Skip files that are unchanged on the device
+    :type skip_unchanged:   bool
+    :param manifest:        (Optional) path to a JSON file that records the
+                            checksums of uploaded files for each device.
+                            With a manifest, files whose modification time
+                            changed but whose content did not are skipped,
+                            too.
+    :type manifest:         str/unicode
+    :rtype:                 :class:`UploadStats`
+    """
+    start = time.time()
+    remote_path = util.to_camerapath(remote_path).rstrip('/')
+    files = [(local, posixpath.join(remote_path, rel), os.stat(local))
+             for local, rel in _local_files(local_paths)]
+    manifest_data = {}
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest) as fp:
+            manifest_data = json.load(fp)
+    records = manifest_data.setdefault(device.info.serial_num, {})
+    if skip_unchanged:
+        remote_stats = stat_remote(device, [remote for _, remote, _ in files])
+    else:
+        remote_stats = [None]*len(files)
+    uploaded, skipped = [], []
+    uploaded_bytes = saved_bytes = 0
+    changed = []
+    for (local, remote, local_stat), remote_stat in zip(files, remote_stats):
+        if _is_unchanged(local, local_stat, remote_stat, records.get(remote)):
+            skipped.append(remote)
+            saved_bytes += local_stat.st_size
+        else:
+            changed.append((local, remote, local_stat))
+    if changed:
+        directories = set()
+        for _, remote, _ in changed:
+            parent = posixpath.dirname(remote)
+            while parent not in ('A', '') and parent not in directories:
+                directories.add(parent)
+                parent = posixpath.dirname(parent)
+        if directories:
+            device.evaluate(*("os.mkdir({0})".format(serialize(path))
+                              for path in sorted(directories)))
+        for local, remote, local_stat in changed:
+            device.upload_file(local, remote, skip_checks=True)
+            uploaded.append(remote)
+            uploaded_bytes += local_stat.st_size
+        mtimes = [(remote, int(local_stat.st_mtime))
+                  for _, remote, local_stat in changed]
+        for idx in xrange(0, len(mtimes), STAT_BATCH_SIZE):
+            device.evaluate(*("os.utime({0}, {1}, {1})".format(
+                serialize(remote), mtime)
+                for remote, mtime in mtimes[idx:idx+STAT_BATCH_SIZE]))
+    if manifest is not None:
+        for local, remote, local_stat in changed:
+            records[remote] = (local_stat.st_size, int(local_stat.st_mtime),
+                               _checksum(local))
+        skipped_paths = set(skipped)
+        for (local, remote, _), remote_stat in zip(files, remote_stats):
+            if remote in skipped_paths and remote not in records:
+                records[remote] = (remote_stat['size'], remote_stat['mtime'],
+                                   _checksum(local))
+        with open(manifest, 'w') as fp:
+            json.dump(manifest_data, fp)
+    return UploadStats(uploaded, skipped, uploaded_bytes, saved_bytes,
+                       time.time() - start)
@@ -1,18 +1,21 @@
 import os
 
-from chdkptp.lua import global_lua
+# chdkptp.exposure is imported on use, since it depends on this module
 
 
 def iso_to_sv96(iso):
-    return global_lua.globals.exposure.iso_to_sv96(iso)
+    from chdkptp import exposure
+    return exposure.iso_to_sv96(iso)
 
 
 def shutter_to_tv96(shutter_speed):
-    return global_lua.globals.exposure.shutter_to_tv96(shutter_speed)
+    from chdkptp import exposure
+    return exposure.shutter_to_tv96(shutter_speed)
 
 
 def aperture_to_av96(aperture):
-    return global_lua.globals.exposure.f_to_av96(aperture)
+    from chdkptp import exposure
+    return exposure.aperture_to_av96(aperture)
 
 
 def apex_to_apex96(apex):
@@ -20,7 +23,52 @@ def apex_to_apex96(apex):
     return round(x) if x > 0 else -round(x)
 
 
+def import_numpy():
+    """ Import NumPy for the optional array-based features. """
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("To use NumPy arrays, please install the `numpy` "
+                           "package.")
+    return numpy
+
+
 def to_camerapath(path):
     if not path.lower().startswith("a/"):
         path = os.path.join("A", path)
     return path
+
+
+def glob_to_lua_pattern(pattern):
+    """ Translate a shell-style wildcard pattern (`*`, `?`, `[seq]` and
+        `[!seq]`) into an anchored Lua pattern.
+    """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            out.append('.*')
+        elif char == '?':
+            out.append('.')
+        elif char == '[':
+            end = i
+            if pattern[end:end+1] == '!':
+                end += 1
+            if pattern[end:end+1] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end < 0:
+                out.append('%[')
+                continue
+            seq = pattern[i:end]
+            i = end + 1
+            if seq.startswith('!'):
+                seq = '^' + seq[1:]
+            out.append('[' + seq.replace('%', '%%') + ']')
+        elif not char.isalnum():
+            out.append('%' + char)
+        else:
+            out.append(char)
+    return '^' + ''.join(out) + '$'